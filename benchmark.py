@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+# Copyright 2021 Owkin, inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks of the data loading, communication, training and prediction paths.
+
+Synthetic TCGA-shaped tumor/normal files are generated, then each stage is
+timed. The communication and training benchmarks run both participants as
+local subprocesses of this script. Results are written as JSON.
+"""
+import json
+import os
+import pathlib
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import configargparse
+import numpy as np
+import pandas as pd
+import torch
+
+SRC_DIR = str(pathlib.Path(__file__).parent.joinpath("src").resolve())
+sys.path.insert(0, SRC_DIR)
+
+from models.logistic_regression_model import LogisticRegression, load_model
+from utils.format_data import GENES_COL_NAME, format_data, create_test_dataset_without_split
+from utils.genes_selection import genes_selection_extraction, get_genome_signature
+from utils.pytorch_evaluation import predict
+from utils.tracing import start_tracing, stop_tracing
+
+# Encodings of the models on the wire, compared by the benchmark
+CODEC_BENCHMARKS = [
+    ("none", []),
+    ("fp16", ["--codec", "fp16"]),
+    ("int8", ["--codec", "int8"]),
+    ("int8_delta", ["--codec", "int8", "--delta-encoding"]),
+    ("topk_10", ["--codec", "topk", "--topk-ratio", "0.1"]),
+]
+
+def generate_data_file(file_path, genes, nb_samples, tumor, sample_prefix, random_state):
+    """Write a TCGA-shaped data file: one row per gene, one column per sample.
+    """
+    shift = 0.5 if tumor else 0.0
+    values = random_state.normal(shift, 1.0, size=(len(genes), nb_samples)).astype(np.float32)
+    data = pd.DataFrame(values, columns=["%s-%d" % (sample_prefix, idx) for idx in range(nb_samples)])
+    data.insert(0, GENES_COL_NAME, genes)
+    data.to_csv(file_path, sep="\t", index=False, float_format="%.4f")
+
+def generate_synthetic_data(output_dir, nb_genes, nb_samples, seed=42):
+    """Generate train files for a server and a client, and a test file.
+
+    Train files are named `<tumor|normal>_<server|client>.csv`.
+
+    The genes of all signatures are included, the others are random names, in a
+    shuffled order.
+
+    Returns:
+        dict[str, str]: Paths of the generated files.
+    """
+    random_state = np.random.RandomState(seed)
+    genes = sorted(set(get_genome_signature("union")))
+    genes += ["SYNTH%d" % idx for idx in range(max(0, nb_genes - len(genes)))]
+    random_state.shuffle(genes)
+
+    files = {}
+    nb_normal = max(1, nb_samples // 10)
+    for participant in ["server", "client"]:
+        for label, nb in [("tumor", nb_samples), ("normal", nb_normal)]:
+            files["%s_%s" % (label, participant)] = os.path.join(output_dir, "%s_%s.csv" % (label, participant))
+            generate_data_file(files["%s_%s" % (label, participant)], genes, nb,
+                               label == "tumor", "%s-%s" % (participant, label), random_state)
+    files["test"] = os.path.join(output_dir, "test_samples.csv")
+    generate_data_file(files["test"], genes, nb_samples, True, "test", random_state)
+    return files
+
+def timeit(function, repeats):
+    """Run a function several times and return its timings and last result.
+    """
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+    return {
+        "repeats": repeats,
+        "mean_s": float(np.mean(timings)),
+        "median_s": float(np.median(timings)),
+        "min_s": float(np.min(timings)),
+    }, result
+
+def run_participants(task_args, port):
+    """Run the server and the client of a task as subprocesses, return their JSON outputs.
+    """
+    command = [sys.executable, __file__, "--port", str(port)] + task_args
+    server = subprocess.Popen(command + ["--participant", "server"], stdout=subprocess.PIPE)
+    client = subprocess.Popen(command + ["--participant", "client"], stdout=subprocess.PIPE)
+    outputs = {}
+    for participant, proc in [("client", client), ("server", server)]:
+        stdout, _ = proc.communicate()
+        if proc.returncode != 0:
+            print("The %s subprocess failed." % participant, file=sys.stderr)
+            exit(1)
+        outputs[participant] = json.loads(stdout.decode("utf-8").strip().split("\n")[-1])
+    return outputs
+
+def communication_task(args):
+    """Ping-pong a model between the two participants, the client reports the timings.
+    """
+    from utils.communication import start_server, start_client, stop_server, send_model, receive_model
+
+    model = LogisticRegression(args.model_size)
+    if args.participant == "server":
+        conn = start_server(args.port)
+    else:
+        conn = start_client("localhost", args.port)
+
+    buffer = None
+    timings = []
+    for _ in range(args.repeats):
+        start = time.perf_counter()
+        if args.participant == "client":
+            send_model(conn, model)
+            buffer = receive_model(conn, model, "overwrite", buffer)
+        else:
+            buffer = receive_model(conn, model, "overwrite", buffer)
+            send_model(conn, model)
+        timings.append(time.perf_counter() - start)
+
+    if args.participant == "server":
+        stop_server(conn)
+    else:
+        conn.close()
+    nb_bytes = 4 * (args.model_size + 1)
+    round_trip = float(np.median(timings))
+    return {
+        "model_size": args.model_size,
+        "repeats": args.repeats,
+        "round_trip_median_s": round_trip,
+        "round_trip_min_s": float(np.min(timings)),
+        "throughput_mb_s": 2 * nb_bytes / round_trip / 1e6,
+    }
+
+def walk_task(args):
+    """Train with the walk strategy, report the time per step.
+    """
+    import distant
+    from utils.communication import start_server, start_client, stop_server
+
+    training_args = {
+        "train_tumor": os.path.join(args.data_dir, "tumor_%s.csv" % args.participant),
+        "train_normal": os.path.join(args.data_dir, "normal_%s.csv" % args.participant),
+        "genes_selection": args.genes_selection,
+        "cache_dir": "None",
+        "training_seed": 42 if args.participant == "client" else 141,
+        "learning_rate": 0.5,
+        "sample_rate": 0.1,
+        "noise_multiplier": 1.0,
+        "max_grad_norm": 1.0,
+        "delta": 1e-5,
+        "fl_strategy": "walk",
+        "dp_backend": args.dp_backend,
+        "codec": args.codec,
+        "delta_encoding": args.delta_encoding,
+        "topk_ratio": args.topk_ratio,
+        "fl_rounds": args.repeats,
+        "batches_per_round": 1,
+        "participant": args.participant,
+        "output_file": os.path.join(tempfile.gettempdir(), "benchmark-server_model-%d.pth" % os.getpid()),
+    }
+    dataset = distant.load_training_data(training_args)
+    if args.participant == "server":
+        conn = start_server(args.port)
+    else:
+        conn = start_client("localhost", args.port)
+
+    # The traffic is measured from the spans of the sends
+    if args.count_bytes:
+        tracer = start_tracing(training_args["output_file"] + ".trace.json", args.participant)
+
+    start = time.perf_counter()
+    distant.training(training_args, conn, dataset)
+    duration = time.perf_counter() - start
+
+    result = {
+        "genes_selection": args.genes_selection,
+        "dp_backend": args.dp_backend,
+        "steps": args.repeats,
+        "total_s": duration,
+        "per_step_s": duration / args.repeats,
+    }
+    if args.count_bytes:
+        result["sent_bytes_per_step"] = sum(
+            event["args"]["bytes"] for event in tracer.events if event["name"] == "send.network"
+        ) / args.repeats
+        stop_tracing()
+        os.remove(training_args["output_file"] + ".trace.json")
+
+    if args.participant == "server":
+        stop_server(conn)
+        model, _ = load_model(training_args["output_file"])
+        samples, labels, _ = dataset
+        predictions = predict(model, pd.DataFrame(np.asarray(samples)))[:, 0]
+        result["train_accuracy"] = float(np.mean(predictions == labels))
+        os.remove(training_args["output_file"])
+    else:
+        conn.close()
+    return result
+
+def run_benchmarks(args):
+    results = {}
+    with tempfile.TemporaryDirectory() as data_dir:
+        start = time.perf_counter()
+        files = generate_synthetic_data(data_dir, args.nb_genes, args.nb_samples, args.seed)
+        results["generate_data"] = {"total_s": time.perf_counter() - start}
+
+        results["format_data"], X = timeit(lambda: format_data(files["tumor_server"]), args.repeats)
+        for signature in ["rotterdam", "citbcmst"]:
+            results["genes_selection_extraction_%s" % signature], _ = timeit(
+                lambda: genes_selection_extraction(X, signature), args.repeats)
+
+        for signature in ["rotterdam", "citbcmst"]:
+            for dp_backend in ["opacus", "closed-form"]:
+                print("Benchmarking walk training (%s, %s)..." % (signature, dp_backend), file=sys.stderr)
+                outputs = run_participants([
+                    "--task", "walk",
+                    "--genes-selection", signature,
+                    "--dp-backend", dp_backend,
+                    "--repeats", str(args.steps),
+                    "--data-dir", data_dir,
+                ], args.port)
+                name = "walk_training_%s" % signature
+                if dp_backend != "opacus":
+                    name += "_%s" % dp_backend.replace("-", "_")
+                results[name] = outputs["server"]
+                args.port += 1
+
+        # Traffic and accuracy of the model encodings, on the same training
+        for name, codec_args in CODEC_BENCHMARKS:
+            print("Benchmarking walk training (%s encoding)..." % name, file=sys.stderr)
+            outputs = run_participants([
+                "--task", "walk",
+                "--dp-backend", "closed-form",
+                "--repeats", str(args.steps),
+                "--data-dir", data_dir,
+                "--count-bytes",
+            ] + codec_args, args.port)
+            results["codec_%s" % name] = {
+                "sent_bytes_per_step": outputs["client"]["sent_bytes_per_step"],
+                "train_accuracy": outputs["server"]["train_accuracy"],
+            }
+            args.port += 1
+
+        for model_size in args.model_sizes:
+            print("Benchmarking communication (%d parameters)..." % model_size, file=sys.stderr)
+            outputs = run_participants([
+                "--task", "communication",
+                "--model-size", str(model_size),
+                "--repeats", str(args.exchanges),
+            ], args.port)
+            results["communication_%d" % model_size] = outputs["client"]
+            args.port += 1
+
+        X_test = genes_selection_extraction(create_test_dataset_without_split(files["test"]), "citbcmst")
+        model = LogisticRegression(X_test.shape[1])
+        results["predict"], _ = timeit(lambda: predict(model, X_test), args.repeats)
+        results["predict"]["nb_samples"] = X_test.shape[0]
+
+    return {
+        "config": {
+            "nb_genes": args.nb_genes,
+            "nb_samples": args.nb_samples,
+            "seed": args.seed,
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "torch": torch.__version__,
+        },
+        "results": results,
+    }
+
+
+if __name__ == "__main__":
+    parser = configargparse.ArgParser()
+    parser.add("--output", help="Path of the JSON results file, printed if unset.", type=str, default=None)
+    parser.add("--nb-genes", help="Number of genes of the synthetic files.", type=int, default=20000)
+    parser.add("--nb-samples", help="Number of tumor samples of each synthetic file.", type=int, default=500)
+    parser.add("--seed", help="Seed of the synthetic data.", type=int, default=42)
+    parser.add("--repeats", help="Number of runs of each timed function.", type=int, default=5)
+    parser.add("--steps", help="Number of walk training steps.", type=int, default=50)
+    parser.add("--exchanges", help="Number of model round trips.", type=int, default=200)
+    parser.add("--model-sizes", help="Model input sizes for the communication benchmark.",
+               type=int, nargs="+", default=[69, 263, 20000])
+    parser.add("--port", help="First port used by the subprocesses.", type=int, default=8090)
+
+    # Subprocess tasks
+    parser.add("--task", help=configargparse.SUPPRESS, choices=["communication", "walk"], default=None)
+    parser.add("--participant", help=configargparse.SUPPRESS, choices=["server", "client"], default=None)
+    parser.add("--model-size", help=configargparse.SUPPRESS, type=int, default=69)
+    parser.add("--genes-selection", help=configargparse.SUPPRESS, type=str, default="rotterdam")
+    parser.add("--dp-backend", help=configargparse.SUPPRESS, type=str, default="opacus")
+    parser.add("--codec", help=configargparse.SUPPRESS, type=str, default="none")
+    parser.add("--delta-encoding", help=configargparse.SUPPRESS, action="store_true")
+    parser.add("--topk-ratio", help=configargparse.SUPPRESS, type=float, default=0.01)
+    parser.add("--count-bytes", help=configargparse.SUPPRESS, action="store_true")
+    parser.add("--data-dir", help=configargparse.SUPPRESS, type=str, default=None)
+    args = parser.parse_args()
+
+    if args.task == "communication":
+        print(json.dumps(communication_task(args)))
+    elif args.task == "walk":
+        print(json.dumps(walk_task(args)))
+    else:
+        results = run_benchmarks(args)
+        if args.output is None:
+            print(json.dumps(results, indent=2))
+        else:
+            with open(args.output, "w") as file_writer:
+                json.dump(results, file_writer, indent=2)
@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+# Copyright 2021 Owkin, inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Convert gene data files (tab-separated, one row per gene) to expression
+matrices, which all the programs accept in place of the text files.
+"""
+import os
+
+import configargparse
+
+from src.utils.expression_matrix import MATRIX_SUFFIX
+from src.utils.format_data import convert_to_expression_matrix
+
+if __name__ == "__main__":
+    parser = configargparse.ArgParser()
+    parser.add("--input", help="Paths to the data files to convert.", type=str, nargs="+", required=True)
+    parser.add("--output-dir", help="Output directory, defaults to the directory of each input file.",
+               type=str, default=None)
+    args = parser.parse_args()
+
+    for input_path in args.input:
+        output_dir = args.output_dir if args.output_dir is not None else os.path.dirname(input_path)
+        output_path = os.path.join(output_dir, os.path.splitext(os.path.basename(input_path))[0] + MATRIX_SUFFIX)
+        convert_to_expression_matrix(input_path, output_path)
+        print("%s -> %s" % (input_path, output_path))
@@ -27,18 +27,12 @@ python owkin-submission-training.py \
     --epsilon 1 5 10 --delta 1e-5 1e-4 \
     --output-dir owkin-models --subprocess
 
-for file in owkin-models/*
-do
-    python owkin-submission-predict.py \
-        --output-dir owkin-predictions \
-        --model-path $file \
-        --test-file data/test_samples.csv
-done
+python owkin-submission-predict.py \
+    --output-dir owkin-predictions \
+    --model-dir owkin-models \
+    --test-file data/test_samples.csv \
+    --probabilities
 
-for file in owkin-predictions/*
-do
-    echo $file
-    python owkin-submission-evaluate.py \
-        --labels data/test_labels.csv \
-        --preds $file
-done
+python owkin-submission-evaluate.py \
+    --labels data/test_labels.csv \
+    --preds owkin-predictions/*.csv
@@ -13,37 +13,120 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from statistics import mean
-from numpy import std
+import re
+
 import configargparse
-from pandas import read_csv
-from pandas import concat
-from sklearn.metrics import accuracy_score
+import numpy as np
+import pandas as pd
+
+# (eps, delta) of the result files and wide columns written by the prediction program
+PROFILE_PATTERN = re.compile(r"eps([0-9.e+-]+?)-delta([0-9.e+-]+?)(?:\.csv)?$")
+METRICS = ["accuracy", "auc", "f1", "tp", "fp", "tn", "fn"]
+
+def load_labels(labels_file):
+    """Return the labels of a (tab separated, one column per patient) label file.
+    """
+    labels = pd.read_csv(labels_file, sep="\t").T
+    return labels[0]
+
+def load_predictions(preds_files):
+    """Read all the trials of prediction files, narrow (`pred` column, or one
+    column per trial) or wide (one column per model).
+
+    Returns:
+        (pd.DataFrame, list[str]): Predictions indexed by patient with one
+            column per trial, and the profile of each trial.
+    """
+    trials, profiles = [], []
+    for preds_file in preds_files:
+        preds = pd.read_csv(preds_file, sep=",").set_index("patient_id")
+        file_profile = profile_name(preds_file)
+        for column in preds.columns:
+            column_profile = profile_name(column)
+            profiles.append(column_profile if column_profile is not None else file_profile or preds_file)
+            trials.append(preds[column].rename(len(trials)))
+    return pd.concat(trials, axis="columns"), profiles
+
+def profile_name(name):
+    match = PROFILE_PATTERN.search(name)
+    if match is None:
+        return None
+    return "eps%s-delta%s" % match.groups()
+
+def score_trials(y_true, y_pred):
+    """Compute the metrics of all trials at once.
+
+    Args:
+        y_true (np.ndarray): Binary labels, one per patient.
+        y_pred (np.ndarray): Predictions (binary, or tumor probabilities), one
+            row per patient and one column per trial.
+
+    Returns:
+        dict[str, np.ndarray]: Each metric, one value per trial. The AUC is
+            NaN for the trials of binary predictions, as it needs scores.
+    """
+    positives = y_true == 1
+    nb_pos = positives.sum()
+    nb_neg = len(y_true) - nb_pos
+    hard = y_pred >= 0.5
+
+    tp = hard[positives].sum(axis=0)
+    fp = hard[~positives].sum(axis=0)
+    fn = nb_pos - tp
+    tn = nb_neg - fp
+
+    # Mann-Whitney statistic, ties count for one half
+    ranks = pd.DataFrame(y_pred).rank(axis=0).to_numpy()
+    with np.errstate(invalid="ignore", divide="ignore"):
+        auc = (ranks[positives].sum(axis=0) - nb_pos * (nb_pos + 1) / 2) / (nb_pos * nb_neg)
+        auc[((y_pred == 0) | (y_pred == 1)).all(axis=0)] = np.nan
+        f1 = np.where(tp > 0, 2 * tp / (2 * tp + fp + fn), 0.0)
+    return {
+        "accuracy": (tp + tn) / len(y_true),
+        "auc": auc,
+        "f1": f1,
+        "tp": tp, "fp": fp, "tn": tn, "fn": fn,
+    }
+
+def summarize(scores, profiles):
+    """Average the metrics of the trials of each profile.
+
+    Returns:
+        pd.DataFrame: One row per profile with the number of trials, the mean
+            and standard deviation of each metric.
+    """
+    scores_df = pd.DataFrame(scores)
+    scores_df["profile"] = profiles
+    grouped = scores_df.groupby("profile", sort=False)
+    summary = grouped[METRICS].mean()
+    for metric in ["accuracy", "auc", "f1"]:
+        summary[metric + "_std"] = grouped[metric].std(ddof=0)
+    summary.insert(0, "trials", grouped.size())
+    return summary[["trials", "accuracy", "accuracy_std", "auc", "auc_std", "f1", "f1_std",
+                    "tp", "fp", "tn", "fn"]]
 
 def main(args):
-    labels = read_csv(args.labels, sep="\t")
-    labels = labels.T
-    preds = read_csv(args.preds, sep=",")
-    preds.set_index("patient_id", inplace=True)
-    trials = preds.columns.tolist()
-    # Concat dataframes to be sure that the patients are in the same order
-    df = concat([labels, preds], axis="columns")
-
-    scores = []
-    y_true = df[0].tolist()
-    for trial in trials:
-        y_pred = df[trial].tolist()
-        scores.append(accuracy_score(y_true, y_pred))
-
-    if len(scores) > 1:
-        print("Accuracy: %0.4f (+/- %0.4f)" %  (mean(scores), std(scores)))
-    else:
-        print("Accuracy: %0.4f" %  scores[0])
+    labels = load_labels(args.labels)
+    preds, profiles = load_predictions(args.preds)
+    # Align the patients of the predictions with the labels
+    preds = preds.reindex(labels.index)
+    if preds.isna().any().any():
+        print("Some labelled patients have no prediction.")
+        exit(1)
+
+    scores = score_trials(labels.to_numpy(), preds.to_numpy(dtype=np.float64))
+    summary = summarize(scores, profiles)
+
+    print(summary.to_string(float_format="%0.4f"))
+    if args.output is not None:
+        summary.to_csv(args.output)
 
 if __name__ == "__main__":
     parser = configargparse.ArgParser()
     parser.add("--labels", help="Path to labels file", type=str, required=True)
-    parser.add("--preds", help="Path to predictions file", type=str, required=True)
+    parser.add("--preds", help="Paths to predictions files, one or many trials per file", type=str,
+               nargs="+", required=True)
+    parser.add("--output", help="Path to write the summary table to (CSV)", type=str, default=None)
     args = parser.parse_args()
 
     main(args)
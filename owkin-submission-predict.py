@@ -20,34 +20,150 @@ import torch
 import pandas as pd
 import numpy as np
 
-from src.models.logistic_regression_model import LogisticRegression
-from src.utils.format_data import create_test_dataset_without_split
-from src.utils.genes_selection import genes_selection_extraction
-from src.utils.pytorch_evaluation import predict
+from src.models.logistic_regression_model import load_model
+from src.utils.format_data import TestChunkReader, create_test_dataset_without_split
+from src.utils.genes_selection import genes_selection_by_index, genes_selection_extraction, get_genome_signature
+from src.utils.pytorch_evaluation import predict, predict_many
+
+def select_genes(X_test, artifact):
+    if artifact["genes"] is not None:
+        return genes_selection_by_index(X_test, artifact["genes"])
+    return genes_selection_extraction(X_test, artifact["signature"])
+
+def prediction_threshold(args):
+    return None if args.probabilities else 0.5
+
+def results_file_name(model_path):
+    return os.path.basename(model_path).split("-sizemodel")[0].replace("model", "results") + ".csv"
 
 def main(args):
-    sizemodel = int(args.model_path.split("sizemodel")[1].split(".")[0])
-    model = LogisticRegression(sizemodel).cpu()
-    model.load_state_dict(torch.load(args.model_path))
+    model, artifact = load_model(args.model_path)
 
     X_test = create_test_dataset_without_split(args.test_file)
-    if sizemodel == 69:
-        X_test = genes_selection_extraction(X_test, "rotterdam")
-    else:
-        X_test = genes_selection_extraction(X_test, "citbcmst")
+    X_test = select_genes(X_test, artifact)
 
     prediction_results = pd.DataFrame()
     prediction_results["patient_id"] = X_test.index.tolist()
 
-    y_pred = predict(model, X_test)
+    y_pred = predict(model, X_test, threshold=prediction_threshold(args))
     prediction_results["pred"] = np.squeeze(y_pred)
 
-    output_file = os.path.basename(args.model_path).split("-sizemodel")[0].replace("model", "results") + ".csv"
+    output_file = results_file_name(args.model_path)
     prediction_results.to_csv(
         os.path.join(args.output_dir, output_file),
         index=False
     )
-    
+
+def list_model_paths(model_dir):
+    return sorted(
+        os.path.join(model_dir, file_name)
+        for file_name in os.listdir(model_dir)
+        if file_name.endswith(".pth")
+    )
+
+def load_model_groups(model_paths):
+    """Load models and group them by input genes.
+
+    Returns:
+        (dict, dict): (model path, model) pairs of each group, and an artifact
+            of each group.
+    """
+    groups = {}
+    artifacts = {}
+    for model_path in model_paths:
+        model, artifact = load_model(model_path)
+        key = tuple(artifact["genes"]) if artifact["genes"] is not None else artifact["signature"]
+        groups.setdefault(key, []).append((model_path, model))
+        artifacts[key] = artifact
+    return groups, artifacts
+
+def main_batch(args):
+    """Score every model of a directory, reading the test file once.
+
+    Models are grouped by input genes, each group is scored with a single
+    matrix product.
+    """
+    groups, artifacts = load_model_groups(list_model_paths(args.model_dir))
+
+    X_test = create_test_dataset_without_split(args.test_file)
+    patients = X_test.index.tolist()
+
+    wide_results = pd.DataFrame()
+    wide_results["patient_id"] = patients
+    for key, group in groups.items():
+        y_pred = predict_many([model for _, model in group], select_genes(X_test, artifacts[key]),
+                              threshold=prediction_threshold(args))
+        for idx, (model_path, _) in enumerate(group):
+            output_file = results_file_name(model_path)
+            if args.wide_output is not None:
+                wide_results[output_file[:-len(".csv")]] = y_pred[:, idx]
+                continue
+            prediction_results = pd.DataFrame()
+            prediction_results["patient_id"] = patients
+            prediction_results["pred"] = y_pred[:, idx]
+            prediction_results.to_csv(
+                os.path.join(args.output_dir, output_file),
+                index=False
+            )
+
+    if args.wide_output is not None:
+        wide_results.to_csv(os.path.join(args.output_dir, args.wide_output), index=False)
+
+def main_chunked(args):
+    """Score the test samples by chunks of `args.chunk_size`, appending the
+    predictions to the result files as they are computed.
+
+    Only the rows of the input genes of the models are read, so that memory
+    does not depend on the number of test samples.
+    """
+    model_paths = [args.model_path] if args.model_path is not None else list_model_paths(args.model_dir)
+    groups, artifacts = load_model_groups(model_paths)
+
+    reader = TestChunkReader(args.test_file)
+    genes = {}
+    for key, artifact in artifacts.items():
+        if artifact["genes"] is not None:
+            genes[key] = artifact["genes"]
+        else:
+            # Same selection as genes_selection_extraction
+            genes[key] = sorted(set(get_genome_signature(artifact["signature"])) & set(reader.genes))
+    missing = sorted(set(gene for key in genes for gene in genes[key]) - set(reader.genes))
+    if missing:
+        print("Genes missing from the dataset: %s" % ", ".join(missing))
+        exit(1)
+
+    if args.wide_output is not None:
+        output_files = {None: open(os.path.join(args.output_dir, args.wide_output), "w")}
+    else:
+        output_files = {
+            model_path: open(os.path.join(args.output_dir, results_file_name(model_path)), "w")
+            for model_path in model_paths
+        }
+
+    header = True
+    chunks = {key: reader.iter_chunks(genes[key], args.chunk_size) for key in groups}
+    # Each group reads its own genes, chunk by chunk
+    for group_chunks in zip(*chunks.values()):
+        wide_results = pd.DataFrame()
+        for (key, group), (patients, X_chunk) in zip(groups.items(), group_chunks):
+            wide_results["patient_id"] = patients
+            y_pred = predict_many([model for _, model in group], X_chunk,
+                                  threshold=prediction_threshold(args))
+            for idx, (model_path, _) in enumerate(group):
+                if args.wide_output is not None:
+                    wide_results[results_file_name(model_path)[:-len(".csv")]] = y_pred[:, idx]
+                    continue
+                prediction_results = pd.DataFrame()
+                prediction_results["patient_id"] = patients
+                prediction_results["pred"] = y_pred[:, idx]
+                prediction_results.to_csv(output_files[model_path], header=header, index=False)
+        if args.wide_output is not None:
+            wide_results.to_csv(output_files[None], header=header, index=False)
+        header = False
+
+    for output_file in output_files.values():
+        output_file.close()
+
 
 if __name__ == "__main__":
     parser = configargparse.ArgParser()
@@ -59,11 +175,43 @@ if __name__ == "__main__":
         default="."
     )
 
-    parser.add(
+    model_group = parser.add_mutually_exclusive_group(required=True)
+    model_group.add(
         "--model-path",
         help="Path to the trained model.",
+        type=str
+    )
+
+    model_group.add(
+        "--model-dir",
+        help="Directory of trained models. All the models are scored in one run, "\
+            "with one result file per model.",
+        type=str
+    )
+
+    parser.add(
+        "--wide-output",
+        help="With `--model-dir`, write the predictions of all models as columns "\
+            "of this single result file instead.",
         type=str,
-        required=True
+        default=None
+    )
+
+    parser.add(
+        "--probabilities",
+        help="Write the tumor probability of each sample instead of the 0/1 "\
+            "prediction, to compute the AUC of the models.",
+        default=False,
+        action="store_true"
+    )
+
+    parser.add(
+        "--chunk-size",
+        help="Score the test samples by chunks of this many samples, reading only "\
+            "the genes of the models and appending the predictions to the result "\
+            "files as they are computed.",
+        type=int,
+        default=None
     )
 
     parser.add(
@@ -78,9 +226,16 @@ if __name__ == "__main__":
     )
 
     args = parser.parse_args()
+    if args.wide_output is not None and args.model_dir is None:
+        parser.error("--wide-output requires --model-dir")
 
     # If we need an output directory, make sure it is there.
     os.makedirs(args.output_dir, exist_ok=True)
-    main(args)
+    if args.chunk_size is not None:
+        main_chunked(args)
+    elif args.model_dir is not None:
+        main_batch(args)
+    else:
+        main(args)
 
 
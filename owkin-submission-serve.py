@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# Copyright 2021 Owkin, inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Long-lived scoring service for trained models.
+
+All the models of a directory are loaded once and kept in memory. Clients
+POST expression vectors (in the gene order of the model) to
+`/predict/<model name>` and receive tumor probabilities. Concurrent requests
+for the same model are scored together by a `DynamicBatcher`. `GET /models`
+lists the models with their genes.
+
+Request bodies are either JSON, `{"samples": [[...], ...]}` or
+`{"sample": [...]}`, or raw little-endian float32 values with the
+`application/octet-stream` content type.
+"""
+import json
+import os
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import configargparse
+import numpy as np
+import torch
+
+from src.models.logistic_regression_model import load_model
+from src.utils.pytorch_evaluation import DynamicBatcher
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def load_batchers(model_dir, max_batch_size, max_wait):
+    batchers = {}
+    artifacts = {}
+    for file_name in sorted(os.listdir(model_dir)):
+        if not file_name.endswith(".pth"):
+            continue
+        model, artifact = load_model(os.path.join(model_dir, file_name))
+        batchers[file_name[:-len(".pth")]] = DynamicBatcher(model, max_batch_size, max_wait)
+        artifacts[file_name[:-len(".pth")]] = artifact
+    return batchers, artifacts
+
+def make_handler(batchers, artifacts):
+    class PredictionHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            # One log line per request would dominate the latency
+            pass
+
+        def send_json(self, code, content):
+            body = json.dumps(content).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path != "/models":
+                self.send_json(404, {"error": "Unknown path %s" % self.path})
+                return
+            self.send_json(200, {
+                name: {
+                    "input_size": batcher.input_size,
+                    "genes": artifacts[name]["genes"],
+                    "signature": artifacts[name]["signature"],
+                    "epsilon": artifacts[name]["epsilon"],
+                    "delta": artifacts[name]["delta"],
+                }
+                for name, batcher in batchers.items()
+            })
+
+        def do_POST(self):
+            model_name = self.path[len("/predict/"):] if self.path.startswith("/predict/") else None
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if model_name not in batchers:
+                self.send_json(404, {"error": "Unknown model %s" % model_name})
+                return
+            batcher = batchers[model_name]
+
+            # Media type, without parameters such as the charset
+            media_type = self.headers.get("Content-Type", "").split(";")[0].strip().lower()
+            try:
+                if media_type == "application/octet-stream":
+                    samples = np.frombuffer(body, dtype="<f4").reshape(-1, batcher.input_size)
+                else:
+                    content = json.loads(body)
+                    samples = content["samples"] if "samples" in content else [content["sample"]]
+                probabilities = batcher.predict_proba(np.asarray(samples, dtype=np.float32))
+            except (ValueError, KeyError, TypeError) as error:
+                self.send_json(400, {"error": str(error)})
+                return
+            except Exception as error:
+                self.send_json(500, {"error": repr(error)})
+                return
+            self.send_json(200, {"probabilities": probabilities.tolist()})
+
+    return PredictionHandler
+
+def main(args):
+    # Requests are scored one batch at a time, extra threads only add contention
+    torch.set_num_threads(1)
+    batchers, artifacts = load_batchers(args.model_dir, args.max_batch_size, args.max_wait_ms / 1000.0)
+    handler = make_handler(batchers, artifacts)
+
+    if args.unix_socket is not None:
+        if os.path.exists(args.unix_socket):
+            os.remove(args.unix_socket)
+        server = ThreadingUnixHTTPServer(args.unix_socket, handler)
+        print("Serving %d models on %s" % (len(batchers), args.unix_socket))
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), handler)
+        print("Serving %d models on http://%s:%d" % (len(batchers), args.host, args.port))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    parser = configargparse.ArgParser()
+    parser.add(
+        "--model-dir",
+        help="Directory of the trained models to serve.",
+        type=str,
+        required=True
+    )
+    parser.add("--host", help="Address to listen on.", type=str, default="localhost")
+    parser.add("--port", help="Port to listen on.", type=int, default=8000)
+    parser.add(
+        "--unix-socket",
+        help="Path of a Unix socket to listen on instead of a TCP port.",
+        type=str,
+        default=None
+    )
+    parser.add(
+        "--max-batch-size",
+        help="Maximum number of samples scored in one batch.",
+        type=int,
+        default=256
+    )
+    parser.add(
+        "--max-wait-ms",
+        help="Time to wait for more requests before scoring a batch, in milliseconds. "\
+            "0 scores the requests already waiting without delaying any of them.",
+        type=float,
+        default=0.0
+    )
+    args = parser.parse_args()
+
+    main(args)
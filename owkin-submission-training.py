@@ -13,8 +13,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
 import os
+import socket
 import sys
+import time
 import docker
 import subprocess
 import pathlib
@@ -24,6 +27,8 @@ from configargparse import ArgParser
 
 TRAINING_IMAGE="owkin-submission:latest"
 TRAINING_PROGRAM="src/convert_params_and_train.py"
+# Options of the participants fixed when a resident worker starts
+WORKER_OPTIONS=["--host", "--port", "--nb-clients", "--mode", "--sweep-workers"]
 
 def program_options():
     """Create argument parser for the CLI.
@@ -40,7 +45,7 @@ def program_options():
         help="Path to training data file consisting of data samples corresponding "\
             "to the NORMAL classification label.",
         type=str,
-        required=True
+        default=None
     )
     io_group.add(
         "--train-tumor-alice",
@@ -48,7 +53,7 @@ def program_options():
         help="Path to training data file consisting of data samples corresponding "\
             "to the TUMOR classification label.",
         type=str,
-        required=True
+        default=None
     )
     io_group.add(
         "--train-normal-bob",
@@ -56,7 +61,7 @@ def program_options():
         help="Path to training data file consisting of data samples corresponding "\
             "to the NORMAL classification label.",
         type=str,
-        required=True
+        default=None
     )
     io_group.add(
         "--train-tumor-bob",
@@ -64,7 +69,29 @@ def program_options():
         help="Path to training data file consisting of data samples corresponding "\
             "to the TUMOR classification label.",
         type=str,
-        required=True
+        default=None
+    )
+
+    io_group.add(
+        "--train-normal",
+        metavar="TRAIN-NORMAL-DATA-FILE",
+        nargs="+",
+        help="Paths to the training data files consisting of data samples corresponding "\
+            "to the NORMAL classification label, one per participant. The first "\
+            "participant is the server, the others are clients. Replaces "\
+            "`--train-normal-alice` and `--train-normal-bob`.",
+        type=str,
+        default=None
+    )
+    io_group.add(
+        "--train-tumor",
+        metavar="TRAIN-TUMOR-DATA-FILE",
+        nargs="+",
+        help="Paths to the training data files consisting of data samples corresponding "\
+            "to the TUMOR classification label, one per participant, in the same "\
+            "order as `--train-normal`.",
+        type=str,
+        default=None
     )
 
     # DP Req. Options
@@ -108,6 +135,101 @@ def program_options():
         default="owkin-results"
     )
 
+    parser.add(
+        "--fl-strategy",
+        help="Federated learning strategy. If unset, the strategy of each training "\
+            "profile is used.",
+        choices=["walk", "fedavg", "fedavg-async"],
+        default=None,
+        type=str
+    )
+
+    parser.add(
+        "--sweep-workers",
+        help="Number of worker processes per participant training independent "\
+            "(eps, delta) profiles in parallel. Each worker uses its own port, "\
+            "starting from PORT.",
+        default=None,
+        type=int
+    )
+
+    parser.add(
+        "--codec",
+        help="Encoding of the models sent on the wire: none (float32), fp16, int8 "\
+            "(one scale per model) or topk (largest values of the update only).",
+        choices=["none", "fp16", "int8", "topk"],
+        default=None,
+        type=str
+    )
+
+    parser.add(
+        "--delta-encoding",
+        help="Send the difference with the last model synced on each connection. "\
+            "Always on with the topk codec.",
+        action="store_true"
+    )
+
+    parser.add(
+        "--topk-ratio",
+        help="Share of the values sent by the topk codec.",
+        default=None,
+        type=float
+    )
+
+    parser.add(
+        "--dp-backend",
+        help="Implementation of the DP-SGD step: opacus (default), or the closed form "\
+            "of the logistic regression model, faster with the same privacy accounting.",
+        choices=["opacus", "closed-form"],
+        default=None,
+        type=str
+    )
+
+    parser.add(
+        "--secure-sampling",
+        help="Draw the training batches from a cryptographically secure generator, "\
+            "as the DP noise. Training is then not reproducible.",
+        action="store_true"
+    )
+
+    parser.add(
+        "--early-stop-budget",
+        help="With the walk strategy, stop the training before a round would exceed "\
+            "the requested (epsilon, delta) budget.",
+        action="store_true"
+    )
+
+    parser.add(
+        "--early-stop-patience",
+        help="With the walk strategy, stop the training after this many rounds without "\
+            "improvement of the loss on samples held out by the server.",
+        default=None,
+        type=int
+    )
+
+    parser.add(
+        "--early-stop-min-delta",
+        help="Smallest decrease of the held-out loss counted as an improvement.",
+        default=None,
+        type=float
+    )
+
+    parser.add(
+        "--validation-fraction",
+        help="Share of the server samples held out for `--early-stop-patience` (default 0.1).",
+        default=None,
+        type=float
+    )
+
+    parser.add(
+        "--trace-file",
+        help="Write a timeline trace (Chrome trace format, or one JSON event per line "\
+            "for a .jsonl file) of the training. The file name is suffixed with each "\
+            "participant.",
+        default=None,
+        type=str
+    )
+
     # Next arguments
     comm_group.add(
         "--port",
@@ -123,6 +245,46 @@ def program_options():
         default=False,
         action="store_true"
     )
+
+    comm_group.add(
+        "--loopback",
+        help="If set, all the participants run as threads of this process and exchange "\
+             "models in memory instead of over the network. Takes precedence over "\
+             "`--subprocess`.",
+        default=False,
+        action="store_true"
+    )
+    comm_group.add(
+        "--workers-port",
+        help="Submit the training to resident workers (see `--start-workers`) whose "\
+             "control ports start at this port, instead of spawning new participants.",
+        default=None,
+        type=int
+    )
+
+    comm_group.add(
+        "--workers-host",
+        help="Address of the resident workers. Started workers listen for jobs on "\
+             "this address, use 0.0.0.0 to accept jobs from other machines.",
+        default="localhost",
+        type=str
+    )
+
+    comm_group.add(
+        "--start-workers",
+        help="Start resident workers in subprocesses, listening on `--workers-port`, "\
+             "before submitting the training to them. They keep the libraries, the "\
+             "connection and the datasets loaded for the next submissions.",
+        default=False,
+        action="store_true"
+    )
+
+    comm_group.add(
+        "--stop-workers",
+        help="Stop the resident workers after the training.",
+        default=False,
+        action="store_true"
+    )
     args = parser.parse_args()
 
     # Some post processing, for lists etc.
@@ -132,6 +294,30 @@ def program_options():
     if not isinstance(args.delta, list):
         args.delta = [args.delta,]
 
+    # Alice and Bob are the two participants of the historical setting
+    if args.train_normal is None and args.train_tumor is None:
+        args.train_normal = [args.train_normal_alice, args.train_normal_bob]
+        args.train_tumor = [args.train_tumor_alice, args.train_tumor_bob]
+    if None in args.train_normal or None in args.train_tumor:
+        parser.error("the training files of every participant are required, use either "
+                     "--train-normal/--train-tumor or the Alice/Bob arguments")
+    if len(args.train_normal) != len(args.train_tumor) or len(args.train_normal) < 2:
+        parser.error("--train-normal and --train-tumor must list the same number "
+                     "of participants, at least two")
+    if (args.start_workers or args.stop_workers) and args.workers_port is None:
+        parser.error("--start-workers and --stop-workers require --workers-port")
+    if args.start_workers and not args.subprocess:
+        parser.error("resident workers run as subprocesses, --start-workers requires --subprocess")
+    if args.workers_port is not None and args.sweep_workers is not None and args.sweep_workers > 1:
+        parser.error("resident workers train the profiles one after the other, "
+                     "--sweep-workers is not supported with --workers-port")
+
+    if args.workers_port is not None:
+        # Resident workers may have been started from another directory
+        resolve_path = lambda p: str(pathlib.Path(p).resolve())
+        args.train_normal = [resolve_path(p) for p in args.train_normal]
+        args.train_tumor = [resolve_path(p) for p in args.train_tumor]
+        args.output_dir = resolve_path(args.output_dir)
 
     return args
 
@@ -154,13 +340,21 @@ def list_system_images(docker_client):
 def dict_to_cli_args(arg_dict):
     command_list = []
     for k, v in  arg_dict.items():
-        if k in ["train_normal_alice", "train_tumor_alice", "train_normal_bob", "train_tumor_bob", "subprocess"]: 
+        if k in ["train_normal_alice", "train_tumor_alice", "train_normal_bob", "train_tumor_bob",
+                 "train_normal", "train_tumor", "subprocess", "loopback",
+                 "workers_port", "workers_host", "start_workers", "stop_workers"]:
+            continue
+        # Unset optional arguments keep the default of the training program
+        if v is None or v is False:
             continue
         # 1. convert undercores to hypens
         arg = "--" + k.replace("_", "-")
 
         # 2. Add to list
         command_list.append(arg)
+        if v is True:
+            # Flag
+            continue
         if isinstance(v, list):
             for el in v:
                 command_list.append(str(el))
@@ -169,6 +363,84 @@ def dict_to_cli_args(arg_dict):
     
     return command_list
 
+def start_workers(participant_command_lists, workers_host, workers_port):
+    """Start one resident worker per participant, in the background.
+
+    Worker i receives its jobs on `workers_host`, port `workers_port + i`.
+    """
+    for idx, participant_command_list in enumerate(participant_command_lists):
+        run_command = ["python", TRAINING_PROGRAM] + participant_command_list + [
+            "--mode", "subprocess", "--daemon",
+            "--control-host", workers_host, "--control-port", str(workers_port + idx)]
+        # Own session, so that the workers outlive this launcher
+        subprocess.Popen(run_command, start_new_session=True)
+
+def request_workers(requests, workers_host, workers_port, attempts=5):
+    """Send one request to each resident worker and wait for all the replies.
+
+    Args:
+        requests (list[dict]): Request of each participant, in order. Workers
+            with a None request are skipped.
+        workers_host (str): Address of the workers.
+        workers_port (int): Control port of the first participant.
+        attempts (int, optional): Connection attempts to each worker, one per
+            second, None to wait for workers being started. Defaults to 5.
+
+    Returns:
+        list[dict]: Reply of each participant, None for the skipped ones.
+    """
+    conns = []
+    for idx, request in enumerate(requests):
+        conn = None
+        attempt = 0
+        while request is not None:
+            try:
+                conn = socket.create_connection((workers_host, workers_port + idx))
+                break
+            except socket.error:
+                attempt += 1
+                if attempts is not None and attempt >= attempts:
+                    break
+                print("Worker %d not ready, retrying.." % idx)
+                time.sleep(1)
+        if conn is not None:
+            conn.sendall((json.dumps(request) + "\n").encode("utf-8"))
+        conns.append(conn)
+
+    replies = []
+    for idx, (request, conn) in enumerate(zip(requests, conns)):
+        if request is None:
+            replies.append(None)
+        elif conn is None:
+            replies.append({"status": "error", "message": "worker %d unreachable" % idx})
+        else:
+            with conn, conn.makefile("r") as conn_file:
+                line = conn_file.readline()
+            # A worker closing without a reply has died
+            replies.append(json.loads(line) if line else
+                           {"status": "error", "message": "worker %d closed the connection" % idx, "stopped": True})
+    return replies
+
+def job_command_list(command_list):
+    """Remove from a participant command list the options fixed by its worker.
+
+    Args:
+        command_list (list[str]): A list of flags/commands for the CLI
+
+    Returns:
+        list[str]: The command list without `WORKER_OPTIONS` and their values.
+    """
+    job_list = []
+    skip_value = False
+    for item in command_list:
+        if skip_value:
+            skip_value = False
+        elif item in WORKER_OPTIONS:
+            skip_value = True
+        else:
+            job_list.append(item)
+    return job_list
+
 def add_command(command_list, arg, value):
     """Inplace modification of the command list to append the given command.
 
@@ -187,52 +459,94 @@ def add_command(command_list, arg, value):
 def run_training_and_testing(args):
     """Run an entire training session for these training arguments.
 
+    The first participant (Alice) is the server, all the others are clients.
+
     Args:
         training_args ([type]): [description]
     """
     # We are going to try just calling things on the base system without
     # docker for an instant.
     command_list = dict_to_cli_args(args)
+    nb_clients = len(args["train_normal"]) - 1
+
+    # Now make the separate command list for the different participants
+    participant_command_lists = []
+    for idx, (train_normal, train_tumor) in enumerate(zip(args["train_normal"], args["train_tumor"])):
+        participant_command_list = command_list.copy()
+        if idx == 0:
+            add_command(participant_command_list, "--participant", "server")
+            add_command(participant_command_list, "--training-seed", 141)
+            add_command(participant_command_list, "--nb-clients", nb_clients)
+        else:
+            add_command(participant_command_list, "--participant", "client")
+            add_command(participant_command_list, "--training-seed", 41 + idx)
+        add_command(participant_command_list, "--train-normal", train_normal)
+        add_command(participant_command_list, "--train-tumor", train_tumor)
+        participant_command_lists.append(participant_command_list)
+
+    if args["workers_port"] is not None:
+        if args["start_workers"]:
+            print("Starting resident workers")
+            start_workers(participant_command_lists, args["workers_host"], args["workers_port"])
+
+        print("Training with resident workers")
+        replies = request_workers(
+            [{"argv": job_command_list(participant_command_list)}
+             for participant_command_list in participant_command_lists],
+            args["workers_host"], args["workers_port"],
+            # Just started workers take a while to connect to each other
+            attempts=None if args["start_workers"] else 5
+        )
+        for idx, reply in enumerate(replies):
+            if reply["status"] != "ok":
+                print("Participant %d failed: %s" % (idx, reply.get("message")))
+        print("Trained in %.2fs" % max(reply.get("seconds", 0) for reply in replies))
+
+        if args["stop_workers"]:
+            # Workers whose training failed have already stopped
+            request_workers([None if reply.get("stopped") else {"command": "stop"} for reply in replies],
+                            args["workers_host"], args["workers_port"])
+        if any(reply["status"] != "ok" for reply in replies):
+            exit(1)
 
-    # Now make the separate command list for the two different runs
-    alice_command_list = command_list.copy()
-    bob_command_list = command_list.copy()
+    elif args["loopback"]:
+        print("Training in memory, in this process")
 
-    # Finish Alice Commands
-    add_command(alice_command_list, "--participant", "server")
-    add_command(alice_command_list, "--training-seed", 141)
-    add_command(alice_command_list, "--train-normal", args["train_normal_alice"])
-    add_command(alice_command_list, "--train-tumor", args["train_tumor_alice"])
+        sys.path.insert(0, str(pathlib.Path(TRAINING_PROGRAM).resolve().parent))
+        import convert_params_and_train
 
-    # Finish Bob Commands
-    add_command(bob_command_list, "--participant", "client")
-    add_command(bob_command_list, "--training-seed", 42)
-    add_command(bob_command_list, "--train-normal", args["train_normal_bob"])
-    add_command(bob_command_list, "--train-tumor", args["train_tumor_bob"])
+        participants_args = [
+            convert_params_and_train.program_options(participant_command_list)
+            for participant_command_list in participant_command_lists
+        ]
+        if not convert_params_and_train.run_loopback(participants_args):
+            print("A participant failed.")
+            exit(1)
 
-    if args["subprocess"]:
+    elif args["subprocess"]:
         print("Training with subprocesses")
 
-        add_command(alice_command_list, "--mode", "subprocess")
-        add_command(bob_command_list, "--mode", "subprocess")
-
-        alice_run_command = ["python", TRAINING_PROGRAM] + alice_command_list
-        bob_run_command = ["python", TRAINING_PROGRAM] + bob_command_list
+        procs = []
+        for idx, participant_command_list in enumerate(participant_command_lists):
+            add_command(participant_command_list, "--mode", "subprocess")
+            run_command = ["python", TRAINING_PROGRAM] + participant_command_list
 
-        # Start Alice first
-        print("* Starting Alice node...") 
-        alice_proc = subprocess.Popen(alice_run_command)
+            # Start the server first, wait on the last client
+            if idx == 0:
+                print("* Starting Alice node...")
+            else:
+                print("* Starting client node %d..." % idx)
+            if idx < nb_clients:
+                procs.append(subprocess.Popen(run_command))
+            else:
+                subprocess.call(run_command)
 
-        # Start Bob
-        print("* Starting Bob node...")
-        bob_proc = subprocess.call(bob_run_command)
+        for proc in procs:
+            proc.wait()
 
     else:
         print("Training with docker")
 
-        add_command(alice_command_list, "--mode", "docker")
-        add_command(bob_command_list, "--mode", "docker")
-
         client = docker.from_env()
 
         # Check docker image existence
@@ -243,28 +557,34 @@ def run_training_and_testing(args):
             exit(1)
 
         container_output_dir = '/submission/%s' % args["output_dir"] 
+        volumes = {os.getcwd()+"/data": {'bind': '/submission/data', 'mode': 'ro'},
+                   "%s/%s" % (os.getcwd(), args["output_dir"]): {'bind': container_output_dir, 'mode': 'rw'}}
+
+        server_command_list = participant_command_lists[0]
+        add_command(server_command_list, "--mode", "docker")
         # Launch container for server
         client.containers.run(
             TRAINING_IMAGE,
-            " ".join(alice_command_list),
+            " ".join(server_command_list),
             name="idash-server",
             detach=True,
             auto_remove=True,
-            volumes={os.getcwd()+"/data": {'bind': '/submission/data', 'mode': 'ro'},
-                     "%s/%s" % (os.getcwd(), args["output_dir"]): {'bind': container_output_dir, 'mode': 'rw'}}
+            volumes=volumes
         )
         server_ip = client.containers.get('idash-server').attrs['NetworkSettings']['IPAddress']
         # print("The IP of 'idash-server' is %s" % server_ip)
 
-        # Launch container for client
-        client.containers.run(
-            TRAINING_IMAGE,
-            "%s --host %s" % (" ".join(bob_command_list), server_ip),
-            name="idash-client",
-            auto_remove=True,
-            volumes={os.getcwd()+"/data": {'bind': '/submission/data', 'mode': 'ro'},
-                     "%s/%s" % (os.getcwd(), args["output_dir"]): {'bind': container_output_dir, 'mode': 'rw'}}
-        )
+        # Launch containers for clients, wait on the last one
+        for idx, client_command_list in enumerate(participant_command_lists[1:], start=1):
+            add_command(client_command_list, "--mode", "docker")
+            client.containers.run(
+                TRAINING_IMAGE,
+                "%s --host %s" % (" ".join(client_command_list), server_ip),
+                name="idash-client" if nb_clients == 1 else "idash-client-%d" % idx,
+                detach=idx < nb_clients,
+                auto_remove=True,
+                volumes=volumes
+            )
 
         client.close()
 
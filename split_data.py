@@ -13,45 +13,149 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+"""Split a cohort into a test set and the training sets of the sites.
+
+Each data file (one row per gene, one column per sample) is read once, line by
+line: the sample columns are routed to their shard as the rows stream by. The
+tumor and normal files are split in parallel.
+"""
+import multiprocessing
 import os
+import shutil
+import tempfile
+from operator import itemgetter
 
 import configargparse
-from pandas import concat, DataFrame, read_csv, Series
+import numpy as np
+
+from src.utils.expression_matrix import (MATRIX_SUFFIX, is_expression_matrix, load_expression_matrix,
+                                         save_expression_matrix)
+from src.utils.format_data import GENES_COL_NAME, parse_data_file
+
+def assign_columns(nb_samples, seed, test_proportion, nb_sites):
+    """Assign each sample column to the test set or to a site.
+
+    The test columns are drawn first, then those of each site among the
+    remaining ones, the last site getting the rest. Draws are the ones of
+    pandas `DataFrame.sample(frac=..., random_state=seed)`, so that two sites
+    get the same split as before.
+
+    Returns:
+        list[np.ndarray]: Column indices of the test set, then of each site.
+    """
+    remaining = np.arange(nb_samples)
+    shards = []
+    fractions = [test_proportion] + [1.0 / (nb_sites - site) for site in range(nb_sites - 1)]
+    for fraction in fractions:
+        size = int(round(fraction * len(remaining)))
+        locs = np.random.RandomState(seed).choice(len(remaining), size=size, replace=False)
+        shards.append(remaining[locs])
+        remaining = np.delete(remaining, locs)
+    shards.append(remaining)
+    return shards
+
+def shard_names(data_path, nb_sites, extension):
+    """Return the output files of each site, the first one is the server.
+    """
+    root = data_path[:-len(MATRIX_SUFFIX)] if data_path.endswith(MATRIX_SUFFIX) else data_path.replace(".txt", "")
+    if nb_sites == 2:
+        suffixes = ["server", "client"]
+    else:
+        suffixes = ["server"] + ["client%d" % site for site in range(1, nb_sites)]
+    return ["%s_%s%s" % (root, suffix, extension) for suffix in suffixes]
 
-GENES_COL_NAME="Hybridization REF"
+def make_getter(indices):
+    """Return a function selecting the given items of a list, as a tuple.
+    """
+    if len(indices) == 1:
+        index = int(indices[0])
+        return lambda values: (values[index],)
+    return itemgetter(*indices.tolist()) if len(indices) > 0 else lambda values: ()
 
-def split_dataframe(data_path, seed, test_proportion):
-    data = read_csv(data_path, sep="\t")
-    header = data[GENES_COL_NAME].tolist()
-    data.drop([GENES_COL_NAME], axis="columns", inplace=True)
+def split_file(data_path, seed, test_proportion, nb_sites, output_format, test_path):
+    """Split a data file in one pass, the test shard being written to `test_path`.
 
-    data_test = data.sample(frac=test_proportion, random_state=seed, axis="columns")
-    data.drop(data_test.keys().tolist(), axis="columns", inplace=True)
-    data_test.insert(0, GENES_COL_NAME, header)
+    Returns:
+        int: Number of test samples.
+    """
+    extension = ".csv" if output_format == "csv" else MATRIX_SUFFIX
+    output_paths = [test_path] + shard_names(data_path, nb_sites, extension)
 
-    data_server = data.sample(frac=0.5, random_state=seed, axis="columns")
-    data.drop(data_server.keys().tolist(), axis="columns", inplace=True)
-    data_server.insert(0, GENES_COL_NAME, header)
-    data.insert(0, GENES_COL_NAME, header)
+    if output_format != "csv":
+        # Samples are columns of the matrix, memory-mapped for a matrix input
+        if is_expression_matrix(data_path):
+            values, genes, samples = load_expression_matrix(data_path)
+        else:
+            values, genes, samples = parse_data_file(data_path)
+        shards = assign_columns(len(samples), seed, test_proportion, nb_sites)
+        for output_path, shard in zip(output_paths, shards):
+            save_expression_matrix(output_path, values[:, shard], genes, [samples[idx] for idx in shard])
+        return len(shards[0])
 
-    data_server.to_csv(data_path.replace(".txt", "_server.csv"), sep='\t', index=False)
-    data.to_csv(data_path.replace(".txt", "_client.csv"), sep='\t', index=False)
+    with open(data_path, "r") as file_reader:
+        header = file_reader.readline().rstrip("\r\n").split("\t")
+        samples = header[1:]
+        shards = assign_columns(len(samples), seed, test_proportion, nb_sites)
+        getters = [make_getter(shard) for shard in shards]
 
-    return data_test
+        writers = [open(output_path, "w") for output_path in output_paths]
+        for writer, getter in zip(writers, getters):
+            writer.write("\t".join((GENES_COL_NAME,) + getter(samples)) + "\n")
+        for line in file_reader:
+            fields = line.rstrip("\r\n").split("\t")
+            gene, values = fields[0], fields[1:]
+            for writer, getter in zip(writers, getters):
+                writer.write("\t".join((gene,) + getter(values)) + "\n")
+        for writer in writers:
+            writer.close()
+
+    return len(shards[0])
+
+def merge_test_files(normal_test_path, tumor_test_path, output_path, output_format):
+    """Write the normal then the tumor test samples side by side.
+
+    Rows are matched by position, the gene names are those of the normal file.
+    """
+    if output_format == "csv":
+        with open(normal_test_path, "r") as normal_reader, open(tumor_test_path, "r") as tumor_reader, \
+                open(output_path, "w") as file_writer:
+            for normal_line, tumor_line in zip(normal_reader, tumor_reader):
+                tumor_values = tumor_line.rstrip("\r\n").partition("\t")[2]
+                file_writer.write(normal_line.rstrip("\r\n") + ("\t" + tumor_values if tumor_values else "") + "\n")
+    else:
+        normal_values, genes, normal_samples = load_expression_matrix(normal_test_path)
+        tumor_values, _, tumor_samples = load_expression_matrix(tumor_test_path)
+        save_expression_matrix(output_path, np.concatenate([normal_values, tumor_values], axis=1), genes,
+                               normal_samples + tumor_samples)
 
 def main(args):
-    data_tumor_test = split_dataframe(args.tumor_path, args.seed, args.test_proportion) 
-    data_normal_test = split_dataframe(args.normal_path, args.seed, args.test_proportion)
-    nb_tumor_samples = data_tumor_test.shape[1] - 1
-    nb_normal_samples = data_normal_test.shape[1] - 1
-    # Save test samples
-    data_tumor_test.drop([GENES_COL_NAME], axis="columns", inplace=True)
-    test_samples = concat([data_normal_test, data_tumor_test], ignore_index=False, axis="columns")
-    test_samples.to_csv(os.path.join(os.path.dirname(args.tumor_path), "test_samples.csv"), sep='\t', index=False)
-    # Save test labels
-    patients = test_samples.columns.tolist()[1:]
-    test_labels = DataFrame([[0] * nb_normal_samples + [1] * nb_tumor_samples], columns=patients)
-    test_labels.to_csv(os.path.join(os.path.dirname(args.tumor_path), "test_labels.csv"), sep='\t', index=False)
+    output_dir = os.path.dirname(args.tumor_path)
+    tmp_dir = tempfile.mkdtemp(dir=output_dir or ".")
+    extension = ".csv" if args.format == "csv" else MATRIX_SUFFIX
+    test_paths = [os.path.join(tmp_dir, "tumor" + extension), os.path.join(tmp_dir, "normal" + extension)]
+    jobs = [
+        (data_path, args.seed, args.test_proportion, args.nb_sites, args.format, test_path)
+        for data_path, test_path in zip([args.tumor_path, args.normal_path], test_paths)
+    ]
+    try:
+        with multiprocessing.Pool(len(jobs)) as pool:
+            nb_tumor_samples, nb_normal_samples = pool.starmap(split_file, jobs)
+
+        # Save test samples
+        test_file = os.path.join(output_dir, "test_samples" + extension)
+        merge_test_files(test_paths[1], test_paths[0], test_file, args.format)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    # Save test labels, normal samples first
+    if args.format == "csv":
+        with open(test_file, "r") as file_reader:
+            patients = file_reader.readline().rstrip("\r\n").split("\t")[1:]
+    else:
+        patients = load_expression_matrix(test_file)[2]
+    with open(os.path.join(output_dir, "test_labels.csv"), "w") as file_writer:
+        file_writer.write("\t".join(patients) + "\n")
+        file_writer.write("\t".join(["0"] * nb_normal_samples + ["1"] * nb_tumor_samples) + "\n")
 
 if __name__ == "__main__":
     parser = configargparse.ArgParser()
@@ -59,6 +163,13 @@ if __name__ == "__main__":
     parser.add("--normal-path", help="Path to normal file", type=str, required=True)
     parser.add("--seed", help="Seed used.", type=int, default=42)
     parser.add("--test-proportion", help="Test set proportion.", type=float, default=0.2)
+    parser.add("--nb-sites", help="Number of training sites, the first one is the server.", type=int, default=2)
+    parser.add("--format", help="Output format: tab-separated text, or binary expression matrices (.expr).",
+               choices=["csv", "binary"], default="csv")
     args = parser.parse_args()
 
+    if args.nb_sites < 2:
+        parser.error("--nb-sites must be at least 2")
+    if args.format == "csv" and (is_expression_matrix(args.tumor_path) or is_expression_matrix(args.normal_path)):
+        parser.error("expression matrices are split into expression matrices, use --format binary")
     main(args)
@@ -13,25 +13,43 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
 import os
+import socket
 import sys
 import pathlib
 import time
 import shutil
+import multiprocessing
+import threading
 
+from argparse import Namespace
 from itertools import product
 from configargparse import ArgParser
 
+import torch
+
 import profiles
 import distant
-from utils.communication import start_server, stop_server, start_client
+from utils.communication import accept_clients, stop_server, start_client
+from utils.loopback import loopback_federation
+from utils.dataset_cache import DEFAULT_CACHE_DIR
+from utils.tracing import participant_trace_file, start_tracing, stop_tracing
 
 DISTANT_OUTPUT_FILE="server_model.pth"
+# Options set when a resident worker starts, that its jobs cannot change
+WORKER_OPTIONS = ["--host", "--port", "--nb-clients", "--mode", "--sweep-workers",
+                  "--daemon", "--control-host", "--control-port"]
 
-def program_options():
+def program_options(argv=None, allow_abbrev=True):
     """Create argument parser for the CLI.
+
+    Args:
+        argv (list[str], optional): Arguments to parse. Defaults to the command line.
+        allow_abbrev (bool, optional): Accept unambiguous prefixes of the options.
+            Defaults to True.
     """
-    parser = ArgParser()
+    parser = ArgParser(allow_abbrev=allow_abbrev)
     dp_group = parser.add_argument_group(title="Required DP Parameters")
     io_group = parser.add_argument_group(title="Required Train Data Parameters")
 
@@ -100,6 +118,41 @@ def program_options():
         default=42
     )
 
+    parser.add(
+        "--codec",
+        help="Encoding of the models sent on the wire.",
+        choices=["none", "fp16", "int8", "topk"],
+        default="none",
+        type=str
+    )
+
+    parser.add(
+        "--delta-encoding",
+        help="Send differences with the last synced model.",
+        action="store_true"
+    )
+
+    parser.add(
+        "--topk-ratio",
+        help="Share of the values sent by the topk codec.",
+        default=0.01,
+        type=float
+    )
+
+    parser.add(
+        "--dp-backend",
+        help="Implementation of the DP-SGD step: opacus, or the closed form of the logistic regression.",
+        choices=["opacus", "closed-form"],
+        default="opacus",
+        type=str
+    )
+
+    parser.add(
+        "--secure-sampling",
+        help="Draw the training batches from a cryptographically secure generator.",
+        action="store_true"
+    )
+
     parser.add(
         "--output-dir",
         help="Directory to store output result files to. If the directory does not "\
@@ -108,6 +161,71 @@ def program_options():
         default="."
     )
 
+    parser.add(
+        "--fl-strategy",
+        help="Federated learning strategy. If unset, the strategy of the training "\
+            "profile is used. \"walk\" passes the model from one participant to the "\
+            "other at every step, \"fedavg\" runs the steps of a round locally on each "\
+            "participant and averages the models at the end of the round.",
+        choices=["walk", "fedavg", "fedavg-async"],
+        default=None,
+        type=str
+    )
+
+    parser.add(
+        "--early-stop-budget",
+        help="With the walk strategy, stop before a round would exceed the requested "\
+            "(epsilon, delta) budget. All participants must use the same value.",
+        action="store_true"
+    )
+
+    parser.add(
+        "--early-stop-patience",
+        help="With the walk strategy, stop after this many rounds without improvement "\
+            "of the loss on samples held out by the server. 0 disables it. All "\
+            "participants must use the same value.",
+        default=0,
+        type=int
+    )
+
+    parser.add(
+        "--early-stop-min-delta",
+        help="Smallest decrease of the held-out loss counted as an improvement.",
+        default=0.0,
+        type=float
+    )
+
+    parser.add(
+        "--validation-fraction",
+        help="Share of the server samples held out for `--early-stop-patience`.",
+        default=0.1,
+        type=float
+    )
+
+    parser.add(
+        "--cache-dir",
+        help="Directory where parsed training datasets are cached between runs. "\
+            "Use \"None\" to disable the cache.",
+        type=str,
+        default=DEFAULT_CACHE_DIR
+    )
+
+    parser.add(
+        "--nb-clients",
+        help="Number of clients the server waits for before training.",
+        default=1,
+        type=int
+    )
+
+    parser.add(
+        "--sweep-workers",
+        help="Number of worker processes training independent (eps, delta) profiles "\
+            "in parallel. Worker i communicates on port PORT + i, so both participants "\
+            "must use the same value.",
+        default=1,
+        type=int
+    )
+
     parser.add(
         "--host",
         help="Specifies the server address.",
@@ -130,7 +248,35 @@ def program_options():
         type=str
     )
 
-    args = parser.parse_args()
+    parser.add(
+        "--daemon",
+        help="Stay resident and train the jobs submitted on the control port, "\
+            "instead of the given profiles.",
+        action="store_true"
+    )
+
+    parser.add(
+        "--control-host",
+        help="Address on which a resident worker (`--daemon`) receives its jobs.",
+        default="localhost",
+        type=str
+    )
+
+    parser.add(
+        "--control-port",
+        help="Port on which a resident worker (`--daemon`) receives its jobs.",
+        default=9081,
+        type=int
+    )
+
+    parser.add(
+        "--trace-file",
+        help="Write a timeline trace of the training, one file per participant (and sweep worker).",
+        default=None,
+        type=str
+    )
+
+    args = parser.parse_args(argv)
 
     # Some post processing, for lists etc.
     if not isinstance(args.epsilon, list):
@@ -149,7 +295,7 @@ def program_options():
 
     return args
 
-def run_training_and_testing(delta, prog_args, training_args, conn):
+def run_training_and_testing(epsilon, delta, prog_args, training_args, conn, dataset=None):
     """Runt an entire training session for these training arguments.
 
     Args:
@@ -161,42 +307,239 @@ def run_training_and_testing(delta, prog_args, training_args, conn):
         concat_args[key] = prog_args[key]
     for key in training_args:
         concat_args[key] = training_args[key]
+    concat_args["epsilon"] = epsilon
     concat_args["delta"] = delta
-    del concat_args["epsilon"]
-    return distant.training(concat_args, conn)
-
+    # An explicit strategy takes precedence over the profile one
+    if prog_args.get("fl_strategy") is not None:
+        concat_args["fl_strategy"] = prog_args["fl_strategy"]
+    return distant.training(concat_args, conn, dataset)
 
-if __name__ == "__main__":
-    args = program_options()
+def run_sweep(args, sweep, conn, worker=0, datasets=None):
+    """Train the given (eps, delta) profiles back to back on one connection.
 
-    if args.participant == "server":
-        # If we need an output directory, make sure it is there.
-        os.makedirs(args.output_dir, exist_ok=True)
+    Each dataset (one per gene signature) is loaded once for the whole sweep.
 
-    # Startup networking
-    if args.participant == "server":
-        conn = start_server(args.port, mode=args.mode)
-    else:
-        conn = start_client(args.host, args.port)
+    Args:
+        args (Namespace): Program arguments.
+        sweep (list[tuple[float, float]]): (epsilon, delta) profiles to train.
+        conn (socket or list[socket]): Connection(s) to the other participants.
+        worker (int, optional): Index of the sweep worker. Defaults to 0.
+        datasets (dict, optional): Loaded datasets, kept across sweeps.
+    """
+    prog_args = vars(args).copy()
+    prog_args["output_file"] = os.path.join(args.output_dir, f"worker{worker}-{DISTANT_OUTPUT_FILE}")
+    if datasets is None:
+        datasets = {}
+    # Resolve all the profiles up front, so that an unknown one fails before any training
+    sweep_args = profiles.lookup_training_profiles([eps for eps, _ in sweep], [delta for _, delta in sweep])
 
-    for epsilon, delta in product(args.epsilon, args.delta):
+    for (epsilon, delta), train_args in zip(sweep, sweep_args):
         print(f"Training for profile (eps={epsilon}, delta={delta})")
-        train_args = profiles.lookup_training_profile(epsilon, delta)
+
+        signature = train_args["genes_selection"]
+        dataset_key = (args.train_tumor, args.train_normal, signature)
+        if dataset_key not in datasets:
+            datasets[dataset_key] = distant.load_training_data({**prog_args, "genes_selection": signature})
 
         # Now we just need to punch in this training call.
         # launch distant script with the correct parameters
-        sizemodel = run_training_and_testing(delta, vars(args), train_args, conn)
+        sizemodel = run_training_and_testing(epsilon, delta, prog_args, train_args, conn, datasets[dataset_key])
 
         # From here, we now need to move the output to the right result
         # directories.
         if args.participant == "server":
             shutil.move(
-                DISTANT_OUTPUT_FILE,
+                prog_args["output_file"],
                 os.path.join(
                     args.output_dir,
                     f"owkin-model-eps{epsilon}-delta{delta}-sizemodel{sizemodel}.pth"
                 )
             )
 
+def run_sweep_worker(args, sweep, worker=0, nb_workers=1):
+    """Open a dedicated connection on port `args.port + worker` and run a sweep on it.
+    """
+    if nb_workers > 1:
+        # Share the cores between the workers instead of oversubscribing them
+        torch.set_num_threads(max(1, multiprocessing.cpu_count() // nb_workers))
+
+    if args.trace_file is not None:
+        start_tracing(
+            participant_trace_file(args.trace_file, args.participant, worker if nb_workers > 1 else None),
+            args.participant
+        )
+
+    # Startup networking
+    if args.participant == "server":
+        conn = accept_clients(args.port + worker, args.nb_clients, mode=args.mode)
+    else:
+        conn = start_client(args.host, args.port + worker)
+
+    run_sweep(args, sweep, conn, worker)
+
     if args.participant == "server":
         stop_server(conn)
+    if args.trace_file is not None:
+        stop_tracing()
+
+def parse_job(argv, worker_args):
+    """Parse the arguments of a job submitted to a resident worker.
+
+    Options are not abbreviated, so that a prefix cannot set a WORKER_OPTIONS.
+
+    Raises:
+        ValueError: If the job sets an option of the worker connection, or is
+            meant for another participant.
+    """
+    rejected = [arg for arg in argv if arg.split("=")[0] in WORKER_OPTIONS]
+    if rejected:
+        raise ValueError("Options of the worker, not of a job: %s" % ", ".join(rejected))
+    job_args = program_options(argv, allow_abbrev=False)
+    if job_args.participant != worker_args.participant:
+        raise ValueError("Job of the %s sent to the %s worker" % (job_args.participant, worker_args.participant))
+    return job_args
+
+def serve_jobs(args):
+    """Stay resident and train the sweeps submitted on the control port.
+
+    The connection to the other participants and the loaded datasets are kept
+    across jobs, so that a job starts without paying the imports, the
+    connection setup or the data loading. A job is one JSON line
+    `{"argv": [...]}` holding the arguments of this program for this
+    participant, without the WORKER_OPTIONS; `{"command": "stop"}` stops the
+    worker. Each request gets a JSON line reply. All participants must be sent
+    the same jobs in the same order. The profiles of a job are trained one
+    after the other, on the single connection of the worker.
+
+    A job failing during training may leave frames in flight on the
+    connection: the worker then replies with `"stopped": true` and stops,
+    closing the connection so that the other participants stop too.
+    """
+    if args.participant == "server":
+        conn = accept_clients(args.port, args.nb_clients, mode=args.mode)
+    else:
+        conn = start_client(args.host, args.port)
+
+    listener = socket.socket()
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((args.control_host, args.control_port))
+    listener.listen(1)
+    print(f"Worker {args.participant} ready on control port {args.control_port}")
+
+    datasets = {}
+    running = True
+    while running:
+        control, _ = listener.accept()
+        with control, control.makefile("rw") as control_file:
+            request = json.loads(control_file.readline())
+            if request.get("command") == "stop":
+                control_file.write(json.dumps({"status": "stopped"}) + "\n")
+                break
+
+            start = time.perf_counter()
+            try:
+                job_args = parse_job(request["argv"], args)
+            except (Exception, SystemExit) as error:
+                # Nothing was exchanged, the worker can take the next job
+                control_file.write(json.dumps({"status": "error", "message": repr(error)}) + "\n")
+                continue
+
+            try:
+                if job_args.participant == "server":
+                    os.makedirs(job_args.output_dir, exist_ok=True)
+                if job_args.trace_file is not None:
+                    start_tracing(participant_trace_file(job_args.trace_file, job_args.participant),
+                                  job_args.participant)
+                try:
+                    run_sweep(job_args, list(product(job_args.epsilon, job_args.delta)), conn, datasets=datasets)
+                finally:
+                    if job_args.trace_file is not None:
+                        stop_tracing()
+                reply = {"status": "ok", "seconds": time.perf_counter() - start}
+            except (Exception, SystemExit) as error:
+                reply = {"status": "error", "message": repr(error) + ", worker stopped", "stopped": True}
+                running = False
+            control_file.write(json.dumps(reply) + "\n")
+
+    listener.close()
+    stop_server(conn)
+
+def run_loopback(participants_args):
+    """Run the sweeps of all the participants in this process, as threads
+    exchanging models in memory.
+
+    Runs are deterministic: the DP noise and the batches are drawn from
+    generators seeded with the training seed of each participant.
+
+    Args:
+        participants_args (list[Namespace]): Program arguments of the server,
+            then of each client.
+
+    Returns:
+        bool: True if all the participants succeeded.
+    """
+    server_args = participants_args[0]
+    sweep = list(product(server_args.epsilon, server_args.delta))
+    server_conns, client_conns = loopback_federation(len(participants_args) - 1)
+
+    if server_args.trace_file is not None:
+        start_tracing(participant_trace_file(server_args.trace_file, "loopback"), "loopback")
+
+    failures = []
+    def run_participant(args, conn):
+        try:
+            run_sweep(Namespace(**vars(args), deterministic=True), sweep, conn)
+        except BaseException as error:
+            failures.append(error)
+            # Unblock the other participants
+            stop_server(conn)
+            raise
+
+    threads = [threading.Thread(target=run_participant, args=(server_args, server_conns))]
+    threads += [
+        threading.Thread(target=run_participant, args=(args, conn))
+        for args, conn in zip(participants_args[1:], client_conns)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if server_args.trace_file is not None:
+        stop_tracing()
+    return not failures
+
+
+if __name__ == "__main__":
+    args = program_options()
+
+    if args.participant == "server":
+        # If we need an output directory, make sure it is there.
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    if args.daemon:
+        if args.sweep_workers > 1:
+            print("A resident worker trains the profiles one after the other, --sweep-workers is not supported.")
+            exit(1)
+        serve_jobs(args)
+        exit(0)
+
+    sweep = list(product(args.epsilon, args.delta))
+    nb_workers = max(1, min(args.sweep_workers, len(sweep)))
+
+    if nb_workers == 1:
+        run_sweep_worker(args, sweep)
+    else:
+        # Profiles are dealt round-robin, identically on all participants
+        context = multiprocessing.get_context("spawn")
+        workers = [
+            context.Process(target=run_sweep_worker, args=(args, sweep[worker::nb_workers], worker, nb_workers))
+            for worker in range(nb_workers)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        if any(worker.exitcode != 0 for worker in workers):
+            print("A sweep worker failed.")
+            exit(1)
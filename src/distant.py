@@ -14,6 +14,7 @@
 # limitations under the License.
 
 import random
+import threading
 
 from warnings import filterwarnings
 import configargparse
@@ -23,74 +24,186 @@ import pandas as pd
 import torch
 from opacus.privacy_engine import PrivacyEngine
 
-from utils.format_data import create_dataset_without_split
-from utils.genes_selection import genes_selection_extraction
-from models.logistic_regression_model import LogisticRegression
-from utils.communication import start_server, stop_server, start_client, send_model, receive_model, send_ack, receive_ack
+from utils.dataset_cache import DEFAULT_CACHE_DIR, load_cached_dataset
+from utils.sampler import PoissonSampler
+from utils.dp_sgd import LogisticRegressionDPSGD
+from utils.early_stopping import EarlyStopping
+from utils.privacy_accountant import compute_epsilon
+from utils.tracing import get_tracer, participant_trace_file, start_tracing, stop_tracing
+from models.logistic_regression_model import LogisticRegression, save_model
+from utils.communication import (accept_clients, stop_server, start_client, send_model, send_model_all,
+                                 receive_model, receive_all, aggregate_models, load_flat_model,
+                                 count_parameters, flatten_model, set_codec, send_flag, receive_flag)
+from utils.async_communication import AsyncChannel
 
 filterwarnings('ignore')
 
-def training(args, conn):
-    # Create datasets 
-    X_train, y_train = create_dataset_without_split(
-        args["train_tumor"], 
-        args["train_normal"], 
-        42
-    )
+# RDP orders used for the privacy accounting
+ALPHAS = [1 + x / 10.0 for x in range(1, 100)] + list(range(12, 64))
+DISTANT_OUTPUT_FILE = "server_model.pth"
+SEEDING_LOCK = threading.Lock()
+
+def load_training_data(args):
+    """Create the training dataset of a participant, with feature extraction.
 
-    # Feature Extraction
-    if args["genes_selection"] != "None":
-        X_train = genes_selection_extraction(X_train, args["genes_selection"])
-
-    # Initialize all seeds for reproducibility
-    seed = args['training_seed']
-    torch.manual_seed(seed)
-    np.random.seed(seed)
-    random.seed(seed)
-
-    model = LogisticRegression(X_train.shape[1])
-    criterion = torch.nn.BCELoss(size_average=True)
-    optimizer = torch.optim.SGD(model.parameters(), lr=args['learning_rate'])
-    privacy_engine = PrivacyEngine(
-        model,
-        sample_rate=args['sample_rate'],
-        alphas=[1 + x / 10.0 for x in range(1, 100)] + list(range(12, 64)),
-        noise_multiplier=args['noise_multiplier'],
-        max_grad_norm=args['max_grad_norm'],
-        secure_rng=True
+    Returns:
+        (np.ndarray, np.ndarray, list[str]): samples, labels and ordered genes.
+    """
+    return load_cached_dataset(
+        args["train_tumor"],
+        args["train_normal"],
+        args["genes_selection"],
+        42,
+        args.get("cache_dir", DEFAULT_CACHE_DIR)
     )
-    privacy_engine.attach(optimizer)
 
-    samples = X_train.to_numpy(dtype="float32")
-    labels = y_train.astype("float32")
+def training(args, conn, dataset=None):
+    """Train a model with one participant of the federation.
 
-    if args['fl_strategy'] == "walk":
-        model, optimizer = walk_training(samples, labels, model, optimizer, criterion, args['participant'], conn,
-                                     args['fl_rounds'], args['batches_per_round'], args['sample_rate'])
-    else:
-        print("Unkown strategy %s." % args['fl_strategy'])
-        exit(1)
+    Args:
+        args (dict): Training arguments.
+        conn (socket or list[socket]): Connection to the server for a client,
+            connection(s) to all the clients for the server.
+        dataset (tuple, optional): Already loaded output of `load_training_data`.
+    """
+    if dataset is None:
+        dataset = load_training_data(args)
+    samples, labels, genes = dataset
+
+    # Only the walk strategy stops early
+    early_stop = args['fl_strategy'] == "walk" and (
+        args.get('early_stop_budget', False) or args.get('early_stop_patience', 0) > 0)
+
+    # The server holds out the last (already shuffled) samples to track the validation loss
+    validation_set = None
+    if early_stop and args['participant'] == "server" and args.get('early_stop_patience', 0) > 0:
+        nb_valid = int(round(args.get('validation_fraction', 0.1) * len(samples)))
+        validation_set = (
+            torch.from_numpy(np.require(samples[len(samples) - nb_valid:], np.float32, ["C", "W"])),
+            torch.from_numpy(np.require(labels[len(samples) - nb_valid:], np.float32, ["C", "W"]))
+        )
+        samples, labels = samples[:len(samples) - nb_valid], labels[:len(samples) - nb_valid]
+
+    # Participants simulated in one process (utils.loopback) share the global
+    # generators: seed and draw under a lock to keep the initial models and
+    # the batches reproducible
+    with SEEDING_LOCK:
+        # Initialize all seeds for reproducibility
+        seed = args['training_seed']
+        torch.manual_seed(seed)
+        np.random.seed(seed)
+        random.seed(seed)
+
+        # Deterministic runs (simulations) draw the noise from a seeded generator
+        # of the participant instead of a CSPRNG
+        deterministic = args.get('deterministic', False)
+        noise_generator = torch.Generator().manual_seed(seed) if deterministic else None
+
+        model = LogisticRegression(len(genes))
+        criterion = torch.nn.BCELoss(size_average=True)
+        if args.get('dp_backend', "opacus") == "closed-form":
+            optimizer = LogisticRegressionDPSGD(
+                model,
+                lr=args['learning_rate'],
+                sample_rate=args['sample_rate'],
+                noise_multiplier=args['noise_multiplier'],
+                max_grad_norm=args['max_grad_norm'],
+                alphas=ALPHAS,
+                target_delta=args['delta'],
+                secure_rng=not deterministic,
+                generator=noise_generator
+            )
+        else:
+            optimizer = torch.optim.SGD(model.parameters(), lr=args['learning_rate'])
+            privacy_engine = PrivacyEngine(
+                model,
+                sample_rate=args['sample_rate'],
+                alphas=ALPHAS,
+                noise_multiplier=args['noise_multiplier'],
+                max_grad_norm=args['max_grad_norm'],
+                target_delta=args['delta'],
+                secure_rng=not deterministic
+            )
+            if noise_generator is not None:
+                privacy_engine.random_number_generator = noise_generator
+            privacy_engine.attach(optimizer)
+
+        # Encoding of the models sent by this participant, delta states start over
+        set_codec(conn, args.get('codec', "none"), args.get('delta_encoding', False), args.get('topk_ratio', 0.01))
+
+        # Both strategies take one local step per batch of each round
+        sampler = PoissonSampler(samples, labels, args['sample_rate'], args['fl_rounds'] * args['batches_per_round'],
+                                 secure=args.get('secure_sampling', False) and not deterministic)
+
+    early_stopping = None
+    if early_stop:
+        early_stopping = EarlyStopping(
+            args['batches_per_round'],
+            sample_rate=args['sample_rate'],
+            noise_multiplier=args['noise_multiplier'],
+            alphas=ALPHAS,
+            epsilon=args.get("epsilon") if args.get('early_stop_budget', False) else None,
+            delta=args['delta'],
+            validation_set=validation_set,
+            patience=args.get('early_stop_patience', 0),
+            min_delta=args.get('early_stop_min_delta', 0.0)
+        )
+
+    with get_tracer().span("training", epsilon=args.get("epsilon"), delta=args['delta'],
+                           strategy=args['fl_strategy']):
+        if args['fl_strategy'] == "walk":
+            model, optimizer = walk_training(sampler, model, optimizer, criterion, args['participant'], conn,
+                                             args['fl_rounds'], args['batches_per_round'], early_stopping)
+        elif args['fl_strategy'] == "fedavg":
+            model, optimizer = fedavg_training(sampler, model, optimizer, criterion, args['participant'], conn,
+                                               args['fl_rounds'], args['batches_per_round'])
+        elif args['fl_strategy'] == "fedavg-async":
+            model, optimizer = async_fedavg_training(sampler, model, optimizer, criterion, args['participant'], conn,
+                                                     args['fl_rounds'], args['batches_per_round'])
+        else:
+            print("Unkown strategy %s." % args['fl_strategy'])
+            exit(1)
 
     if args["participant"] == "server":
         model = model.cpu()
-        torch.save(model.state_dict(),  "server_model.pth")
+        nb_rounds = args['fl_rounds']
+        if early_stopping is not None:
+            nb_rounds = early_stopping.rounds
+        nb_steps = nb_rounds * args['batches_per_round']
+        save_model(
+            model,
+            args.get("output_file", DISTANT_OUTPUT_FILE),
+            genes,
+            args["genes_selection"],
+            epsilon=args.get("epsilon"),
+            delta=args.get("delta"),
+            profile=args,
+            training={
+                "rounds": nb_rounds,
+                "steps": nb_steps,
+                "epsilon_spent": compute_epsilon(args['sample_rate'], args['noise_multiplier'], nb_steps,
+                                                 ALPHAS, args['delta']),
+                "stop_reason": early_stopping.stop_reason if early_stopping is not None else None,
+            }
+        )
 
-    return X_train.shape[1]
+    return len(genes)
 
 
-def walk_training(samples, labels, model, optimizer, criterion, participant, conn,
-                  fl_rounds, batches_per_round, sample_rate):
-    model.train()
-    if participant == "client":
-        send_model(conn, model)
+def local_step(sampler, model, optimizer, criterion):
+    tracer = get_tracer()
+    # Create batch
+    with tracer.span("step.batch") as trace_args:
+        x, y = sampler.next_batch()
+        trace_args["batch_size"] = len(x)
 
-    for fl_round in range(fl_rounds):
-        for _ in range(batches_per_round):
-            receive_model(conn, model, "overwrite")
-            # Create batch
-            mask = np.random.uniform(0, 1, len(samples)) < sample_rate
-            x = torch.from_numpy(samples[mask])
-            y = torch.from_numpy(labels[mask])
+    if isinstance(optimizer, LogisticRegressionDPSGD):
+        # Per-sample gradients, clipping and noise in closed form
+        with tracer.span("step.dp_closed_form"):
+            optimizer.step(x, y)
+        privacy_engine = optimizer
+    else:
+        with tracer.span("step.forward_backward"):
             # Forward pass
             y_pred = model(x)
             # Compute Loss
@@ -98,11 +211,137 @@ def walk_training(samples, labels, model, optimizer, criterion, participant, con
             # Backward pass
             optimizer.zero_grad()
             loss.backward()
+        # Per-sample clipping and noise happen in the DP optimizer step
+        with tracer.span("step.dp_optimizer"):
             optimizer.step()
+        privacy_engine = optimizer.privacy_engine
+
+    if tracer.enabled:
+        # Cached RDP curve instead of a full recomputation at each step
+        epsilon = compute_epsilon(privacy_engine.sample_rate, privacy_engine.noise_multiplier,
+                                  privacy_engine.steps, ALPHAS, privacy_engine.target_delta)
+        tracer.counter("privacy", epsilon=epsilon, steps=privacy_engine.steps)
+
+
+def walk_training(sampler, model, optimizer, criterion, participant, conn, fl_rounds, batches_per_round,
+                  early_stopping=None):
+    """Walk the model across the participants, with one batch update per visit.
+
+    The server relays the model to each client in turn and takes its own step
+    between two passes over the clients. With `early_stopping`, the server
+    decides before each round, the first one included, whether to run it, and
+    tells the clients.
+    """
+    model.train()
+    if participant == "client":
+        send_model(conn, model)
+    else:
+        # Every client announces its initial model, start from the first one
+        peers = conn if isinstance(conn, list) else [conn]
+        receive_model(peers[0], model, "overwrite")
+        receive_all(peers[1:], count_parameters(model))
+
+    # Reception buffer reused across all exchanges
+    buffer = None
+    for fl_round in range(fl_rounds):
+        if early_stopping is not None:
+            if participant == "client":
+                if receive_flag(conn):
+                    break
+            else:
+                stop = early_stopping.should_stop(model, criterion)
+                for peer in peers:
+                    send_flag(peer, stop)
+                if stop:
+                    break
+
+        for _ in range(batches_per_round):
+            if participant == "client":
+                buffer = receive_model(conn, model, "overwrite", buffer)
+                local_step(sampler, model, optimizer, criterion)
+                send_model(conn, model)
+            else:
+                local_step(sampler, model, optimizer, criterion)
+                for peer in peers:
+                    send_model(peer, model)
+                    buffer = receive_model(peer, model, "overwrite", buffer)
+
+        if early_stopping is not None:
+            early_stopping.rounds = fl_round + 1
+
+    return model, optimizer
+
+
+def fedavg_training(sampler, model, optimizer, criterion, participant, conn, fl_rounds, batches_per_round):
+    """Federated averaging: in each round, all participants run `batches_per_round`
+    local DP steps at the same time, then the server averages all the models and
+    sends the result back.
+
+    Each participant takes `fl_rounds * batches_per_round` steps on its own data,
+    as in the walk strategy, so the privacy accounting of the `PrivacyEngine` is
+    unchanged: averaging is a post-processing of the noisy models.
+    """
+    model.train()
+    # Start from the first client model, as in the walk strategy
+    if participant == "client":
+        send_model(conn, model)
+        buffer = receive_model(conn, model, "overwrite")
+    else:
+        peers = conn if isinstance(conn, list) else [conn]
+        buffers = receive_all(peers, count_parameters(model))
+        load_flat_model(model, buffers[0])
+        send_model_all(peers, model)
+
+    for fl_round in range(fl_rounds):
+        for _ in range(batches_per_round):
+            local_step(sampler, model, optimizer, criterion)
+
+        if participant == "client":
             send_model(conn, model)
+            buffer = receive_model(conn, model, "overwrite", buffer)
+        else:
+            buffers = aggregate_models(peers, model, buffers)
+            send_model_all(peers, model)
+
+    return model, optimizer
+
 
+def async_fedavg_training(sampler, model, optimizer, criterion, participant, conn, fl_rounds, batches_per_round):
+    """Federated averaging where clients do not wait for the average of a round.
+
+    A client sends its model at the end of a round and starts the next one
+    while the server averages. The average arrives during the next round: the
+    progress made since the send is then applied on top of it (one round of
+    staleness). The server exchanges as in `fedavg_training`. The final model
+    is the average of the last round, and the privacy accounting is the same as
+    `fedavg_training`.
+    """
     if participant == "server":
-        receive_model(conn, model, "overwrite")
+        return fedavg_training(sampler, model, optimizer, criterion, participant, conn,
+                               fl_rounds, batches_per_round)
+
+    model.train()
+    send_model(conn, model)
+    receive_model(conn, model, "overwrite")
+
+    channel = AsyncChannel(conn, model)
+    sent, average = None, None
+    for fl_round in range(fl_rounds):
+        for _ in range(batches_per_round):
+            local_step(sampler, model, optimizer, criterion)
+
+        if average is not None:
+            # Rebase the local progress since the last send on the average
+            data = flatten_model(model)
+            data.sub_(sent).add_(average.result())
+            load_flat_model(model, data)
+
+        sent = channel.send_model(model)
+        average = channel.receive_async()
+
+    load_flat_model(model, average.result())
+    channel.close()
+
     return model, optimizer
 
 if __name__ == "__main__":
@@ -113,30 +352,62 @@ if __name__ == "__main__":
     parser.add("--sample-rate", help="Proba to select each sample in a batch.",
                type=float, default=0.5)
     parser.add("--training-seed", help="Seed used for training.", type=int, default=42)
+    parser.add("--secure-sampling", help="Draw the batches from a cryptographically secure generator.",
+               action="store_true")
 
     parser.add("--noise-multiplier", help="(DP) Noise multiplier.", type=float, default=1.3)
     parser.add("--max-grad-norm", help="(DP) Clipping threshold.", type=float, default=5.0)
+    parser.add("--dp-backend", help="(DP) Implementation of the DP-SGD step: opacus, or the closed form "
+               "of the logistic regression.", choices=["opacus", "closed-form"], default="opacus")
     parser.add("--delta", help="(DP) Target delta.", type=float, default=1e-5)
 
     parser.add("--fl-strategy", help="(FL) FL strategy.",
-               choices=["walk"], default="walk")
+               choices=["walk", "fedavg", "fedavg-async"], default="walk")
     parser.add("--fl-rounds", help="(FL) Number of FL rounds (aggregations).", type=int, default=5)
     parser.add("--batches-per-round", help="(FL) Number of batch updates in one FL round.", type=int, default=1)
 
+    parser.add("--early-stop-budget", help="(FL) Stop the walk before a round would exceed the "
+               "(epsilon, delta) budget.", action="store_true")
+    parser.add("--epsilon", help="(DP) Budget of `--early-stop-budget`.", type=float, default=None)
+    parser.add("--early-stop-patience", help="(FL) Stop the walk after this many rounds without improvement "
+               "of the loss on samples held out by the server, 0 to disable.", type=int, default=0)
+    parser.add("--early-stop-min-delta", help="(FL) Smallest improvement of the held-out loss.",
+               type=float, default=0.0)
+    parser.add("--validation-fraction", help="(FL) Share of the server samples held out for "
+               "`--early-stop-patience`.", type=float, default=0.1)
+
     parser.add("--participant", choices=["client", "server"], required=True)
     parser.add("--train-tumor", help="Path to train tumor file", type=str, required=True)
     parser.add("--train-normal", help="Path to train normal file", type=str, required=True)
 
+    parser.add("--codec", help="(FL) Encoding of the sent models.",
+               choices=["none", "fp16", "int8", "topk"], default="none")
+    parser.add("--delta-encoding", help="(FL) Send differences with the last synced model.",
+               action="store_true")
+    parser.add("--topk-ratio", help="(FL) Share of the values sent by the topk codec.", type=float, default=0.01)
+
+    parser.add("--nb-clients", help="Number of clients the server waits for", type=int, default=1)
     parser.add("--host", help="Server IP address", type=str, default="localhost")
     parser.add("--port", help="Server port", type=int, default=8080)
+    parser.add("--cache-dir", help="Directory of the parsed datasets cache, \"None\" to disable it.",
+               type=str, default=DEFAULT_CACHE_DIR)
     parser.add("--mode", help="Launching mode", type=str, 
                choices=["subprocess", "docker"], default="subprocess")
+    parser.add("--trace-file", help="Write a timeline trace of the training (suffixed with the participant).",
+               type=str, default=None)
 
     args = parser.parse_args()
+    if args.early_stop_budget and args.epsilon is None:
+        parser.error("--early-stop-budget requires --epsilon")
+    if (args.early_stop_budget or args.early_stop_patience > 0) and args.fl_strategy != "walk":
+        parser.error("early stopping is only available with the walk strategy")
+
+    if args.trace_file is not None:
+        start_tracing(participant_trace_file(args.trace_file, args.participant), args.participant)
 
     # Startup networking
     if args.participant == "server":
-        conn = start_server(args.port, mode=args.mode)
+        conn = accept_clients(args.port, args.nb_clients, mode=args.mode)
     else:
         conn = start_client(args.host, args.port)
 
@@ -144,3 +415,5 @@ if __name__ == "__main__":
 
     if args.participant == "server":
         stop_server(conn)
+    if args.trace_file is not None:
+        stop_tracing()
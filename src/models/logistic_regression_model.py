@@ -25,3 +25,73 @@ class LogisticRegression(torch.nn.Module):
         z = self.linear(x)
         y_pred = self.output_activation(z)
         return y_pred
+
+# Training arguments stored in a model artifact
+PROFILE_KEYS = [
+    "genes_selection", "fl_strategy", "sample_rate", "learning_rate", "fl_rounds",
+    "batches_per_round", "max_grad_norm", "noise_multiplier"
+]
+ARTIFACT_VERSION = 1
+
+def save_model(model, model_path, genes, signature, epsilon=None, delta=None, profile=None, training=None):
+    """Save a trained model with everything needed to use it.
+
+    Args:
+        model (LogisticRegression): Trained model.
+        model_path (str): Output file.
+        genes (list[str]): Ordered genes of the model inputs.
+        signature (str): Gene signature the genes were selected from.
+        epsilon (float, optional): (DP) Epsilon of the training profile.
+        delta (float, optional): (DP) Delta of the training profile.
+        profile (dict, optional): Training arguments, only PROFILE_KEYS are kept.
+        training (dict, optional): Outcome of the training (rounds and steps run,
+            epsilon spent, reason of an early stop).
+    """
+    profile = profile or {}
+    torch.save({
+        "version": ARTIFACT_VERSION,
+        "state_dict": model.state_dict(),
+        "genes": list(genes),
+        "signature": signature,
+        "epsilon": epsilon,
+        "delta": delta,
+        "profile": {key: profile[key] for key in PROFILE_KEYS if key in profile},
+        "training": training,
+    }, model_path)
+
+def load_model(model_path):
+    """Load a trained model and its description.
+
+    Files written by `save_model` hold the ordered genes of the model. For
+    older files holding only the weights, the input size is read from the
+    file name (`...-sizemodel<input size>.pth`) and the signature is guessed
+    from it.
+
+    Returns:
+        (LogisticRegression, dict): the model, in evaluation mode, and the artifact
+            description (`sizemodel`, `genes` (None for older files), `signature`,
+            `epsilon`, `delta`, `profile` and `training`).
+    """
+    content = torch.load(model_path)
+    if "state_dict" in content:
+        state_dict = content.pop("state_dict")
+        artifact = content
+        artifact["sizemodel"] = len(artifact["genes"])
+        artifact.setdefault("training", None)
+    else:
+        state_dict = content
+        sizemodel = int(model_path.split("sizemodel")[1].split(".")[0])
+        artifact = {
+            "sizemodel": sizemodel,
+            "genes": None,
+            "signature": "rotterdam" if sizemodel == 69 else "citbcmst",
+            "epsilon": None,
+            "delta": None,
+            "profile": {},
+            "training": None,
+        }
+
+    model = LogisticRegression(artifact["sizemodel"]).cpu()
+    model.load_state_dict(state_dict)
+    model.eval()
+    return model, artifact
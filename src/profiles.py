@@ -15,8 +15,12 @@
 
 """Creating and managing training profiles for different privacy levels
 """
+import bisect
+import functools
 import os
 import pathlib
+
+import numpy as np
 import pandas
 
 # Known profiles, these are the run settings that give us the best predictive
@@ -42,7 +46,7 @@ def load_profiles(profile_file):
     Args:
         profile_file (str): An absolute path to a profile file.
     """
-    profile_df = pandas.read_csv(PROFILE_FILE)
+    profile_df = pandas.read_csv(profile_file)
     profile_df.drop(columns=DROP_COLS, inplace=True)
 
     # Sort all the privacy profiles such that last ones are
@@ -57,36 +61,89 @@ def load_profiles(profile_file):
     return profile_df
 
 
+@functools.lru_cache(maxsize=None)
+def compile_profiles(profile_file=PROFILE_FILE):
+    """Compile a profile file into a table indexed by delta, then epsilon.
+
+    The file is read once per process.
+
+    Args:
+        profile_file (str): An absolute path to a profile file.
+
+    Returns:
+        (np.ndarray, list[np.ndarray], list[list[dict]]): The sorted distinct
+            deltas and, for each of them, the sorted epsilons and the training
+            parameters of the matching profiles.
+    """
+    profile_df = load_profiles(profile_file)
+    deltas = np.unique(profile_df["delta"].to_numpy())
+    epsilons, parameters = [], []
+    for delta in deltas:
+        delta_df = profile_df[profile_df["delta"] == delta]
+        epsilons.append(delta_df["epsilon"].to_numpy())
+        # Remove non-argument keys
+        parameters.append(delta_df.drop(columns=["epsilon", "delta"]).to_dict("records"))
+    return deltas, epsilons, parameters
+
+
 def lookup_training_profile(epsilon, delta):
     """Return training parameters for a given (eps, delta) request.
     """
-    # Read in profiles, they will be sorted according to eps/delta
-    profile_df = load_profiles(PROFILE_FILE)
+    deltas, epsilons, parameters = compile_profiles(PROFILE_FILE)
 
-    # Now that we have the set of all profiles, we want to find the entry 
-    # which is a best match in terms of privacy.
+    # The best match in terms of privacy is, among the profiles with smaller
+    # or equal epsilon and delta, the one with the largest delta, then the
+    # largest epsilon.
 
     # 1. Filter according to delta
-    profile_df = profile_df[profile_df["delta"] <= delta]
+    nb_deltas = bisect.bisect_right(deltas, delta)
 
-    if len(profile_df) == 0:
+    if nb_deltas == 0:
         raise IndexError(f"There exists no appropraite satisfying profile for the requested. (delta={delta})")
 
-    # 2. Filter according to epsilon
-    profile_df = profile_df[profile_df["epsilon"] <= epsilon]
+    # 2. Filter according to epsilon, starting from the closest delta
+    for delta_idx in reversed(range(nb_deltas)):
+        nb_epsilons = bisect.bisect_right(epsilons[delta_idx], epsilon)
+        if nb_epsilons > 0:
+            return dict(parameters[delta_idx][nb_epsilons - 1])
+
+    raise IndexError(f"There exists no appropraite satisfying profile for the requested. (epsilon={epsilon}, delta={delta})")
 
-    if len(profile_df) == 0:
-        raise IndexError(f"There exists no appropraite satisfying profile for the requested. (epsilon={epsilon}, delta={delta})")
 
-    # Return the last element, which will be the privacy profile
-    # closest to the one requested from below.
-    final_profile = profile_df.iloc[-1].to_dict()
+def lookup_training_profiles(epsilons, deltas):
+    """Return training parameters for a grid of (eps, delta) requests.
 
-    # Remove non-argument keys
-    del final_profile["epsilon"]
-    del final_profile["delta"]
+    Equivalent to calling `lookup_training_profile` on each pair, with the
+    searches vectorized over all the requests.
 
-    return final_profile
-    
-    
-     
+    Args:
+        epsilons (array-like): Requested epsilons.
+        deltas (array-like): Requested deltas, same length as `epsilons`.
+
+    Returns:
+        list[dict]: Training parameters of each request.
+    """
+    profile_deltas, profile_epsilons, parameters = compile_profiles(PROFILE_FILE)
+    epsilons = np.asarray(epsilons, dtype=np.float64)
+    deltas = np.asarray(deltas, dtype=np.float64)
+
+    # For each profile delta and request, number of profiles with a smaller
+    # or equal epsilon
+    positions = np.stack([
+        np.searchsorted(delta_epsilons, epsilons, side="right")
+        for delta_epsilons in profile_epsilons
+    ])
+    valid = (positions > 0) & (profile_deltas[:, None] <= deltas[None, :])
+
+    # Largest valid delta of each request
+    delta_indices = len(profile_deltas) - 1 - np.argmax(valid[::-1], axis=0)
+    found = valid.any(axis=0)
+    if not found.all():
+        idx = int(np.argmin(found))
+        raise IndexError(f"There exists no appropraite satisfying profile for the requested. (epsilon={epsilons[idx]}, delta={deltas[idx]})")
+
+    epsilon_indices = positions[delta_indices, np.arange(len(epsilons))] - 1
+    return [
+        dict(parameters[delta_idx][epsilon_idx])
+        for delta_idx, epsilon_idx in zip(delta_indices.tolist(), epsilon_indices.tolist())
+    ]
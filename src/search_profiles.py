@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# Copyright 2021 Owkin, inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Search the training profiles of `profiles.csv`.
+
+Each configuration of the grid is trained by simulating the two-party walk in
+one process, with the closed-form DP-SGD step, and scored on data held out
+from both participants. Its epsilon for each delta is computed with the RDP
+orders of `distant.training`; configurations over the budget are skipped
+before training. Only the configurations improving the accuracy over all the
+more private ones are kept, for each delta.
+"""
+import multiprocessing
+import time
+
+from itertools import product
+from configargparse import ArgParser
+
+import numpy as np
+import pandas as pd
+import torch
+
+from distant import ALPHAS
+from models.logistic_regression_model import LogisticRegression
+from utils.dataset_cache import DEFAULT_CACHE_DIR, load_cached_dataset
+from utils.dp_sgd import LogisticRegressionDPSGD
+from utils.privacy_accountant import compute_epsilon, steps_for_budget
+from utils.sampler import PoissonSampler
+
+# Training seeds of the launcher, the walk starts from the client model
+SERVER_SEED = 141
+CLIENT_SEED = 42
+PROFILE_COLUMNS = [
+    "epsilon", "delta", "acc", "best_metric", "genes_selection", "network", "fl_strategy",
+    "sample_rate", "learning_rate", "fl_rounds", "batches_per_round", "max_grad_norm", "noise_multiplier",
+]
+CONFIG_KEYS = [
+    "genes_selection", "sample_rate", "learning_rate", "fl_rounds", "batches_per_round",
+    "max_grad_norm", "noise_multiplier",
+]
+
+def program_options():
+    """Create argument parser for the CLI.
+    """
+    parser = ArgParser()
+    parser.add("--train-tumor", help="Tumor data files of the server then the client.",
+               type=str, nargs=2, required=True)
+    parser.add("--train-normal", help="Normal data files of the server then the client.",
+               type=str, nargs=2, required=True)
+    parser.add("--valid-fraction", help="Share of the samples of each participant held out for scoring.",
+               type=float, default=0.2)
+    parser.add("--cache-dir", help="Directory of the parsed datasets cache, \"None\" to disable it.",
+               type=str, default=DEFAULT_CACHE_DIR)
+    parser.add("--output", help="Output profiles file.", type=str, default="profiles.csv")
+
+    parser.add("--delta", help="Deltas of the profiles.", type=float, nargs="+",
+               default=[1e-5, 1e-4, 2.5e-4, 5e-4, 7.5e-4, 1e-3, 2.5e-3, 5e-3, 7.5e-3])
+    parser.add("--max-epsilon", help="Largest epsilon of the profiles.", type=float, default=25.0)
+
+    parser.add("--genes-selection", type=str, nargs="+", choices=["rotterdam", "citbcmst"],
+               default=["rotterdam", "citbcmst"])
+    parser.add("--sample-rate", type=float, nargs="+", default=[0.1, 0.3, 0.5, 0.7, 0.9])
+    parser.add("--learning-rate", type=float, nargs="+", default=[0.5, 1.0, 1.5])
+    parser.add("--fl-rounds", type=int, nargs="+", default=[1, 2, 5, 10, 15, 20, 25])
+    parser.add("--batches-per-round", type=int, nargs="+", default=[1, 2, 5, 10])
+    parser.add("--max-grad-norm", type=float, nargs="+", default=[0.5, 1.0, 2.0])
+    parser.add("--noise-multiplier", type=float, nargs="+", default=[1.5, 2.0, 3.0, 4.0, 5.0, 6.0])
+
+    parser.add("--workers", help="Number of processes, defaults to the number of cores.",
+               type=int, default=multiprocessing.cpu_count())
+    return parser.parse_args()
+
+def compute_epsilons(sample_rate, noise_multiplier, steps, deltas):
+    """Return the epsilon of a training for each delta, with the accounting of
+    the `PrivacyEngine` of `distant.training`.
+    """
+    return [compute_epsilon(sample_rate, noise_multiplier, steps, ALPHAS, delta) for delta in deltas]
+
+def split_dataset(dataset, valid_fraction):
+    """Hold out the first samples of an already shuffled dataset.
+
+    Returns:
+        ((np.ndarray, np.ndarray), (np.ndarray, np.ndarray)): train and
+            validation samples and labels.
+    """
+    samples, labels, _ = dataset
+    nb_valid = int(round(valid_fraction * len(samples)))
+    samples = np.asarray(samples, dtype=np.float32)
+    return (samples[nb_valid:], labels[nb_valid:]), (samples[:nb_valid], labels[:nb_valid])
+
+def simulate_walk(train_sets, config):
+    """Train a model with the walk strategy between a server and a client.
+
+    The batches of each participant are drawn as in their own training
+    process. The server takes a step, then the client, for every batch of
+    every round.
+
+    Args:
+        train_sets (list[tuple]): (samples, labels) of the server then the client.
+        config (dict): Training arguments.
+    """
+    nb_steps = config["fl_rounds"] * config["batches_per_round"]
+    samplers = []
+    for (samples, labels), seed in zip(train_sets, [SERVER_SEED, CLIENT_SEED]):
+        np.random.seed(seed)
+        samplers.append(PoissonSampler(samples, labels, config["sample_rate"], nb_steps))
+
+    torch.manual_seed(CLIENT_SEED)
+    model = LogisticRegression(train_sets[0][0].shape[1])
+    optimizers = [
+        LogisticRegressionDPSGD(
+            model,
+            lr=config["learning_rate"],
+            sample_rate=config["sample_rate"],
+            noise_multiplier=config["noise_multiplier"],
+            max_grad_norm=config["max_grad_norm"],
+            alphas=ALPHAS
+        )
+        for _ in samplers
+    ]
+    for _ in range(nb_steps):
+        for sampler, optimizer in zip(samplers, optimizers):
+            optimizer.step(*sampler.next_batch())
+    return model
+
+# Datasets of the worker processes: signature -> (train sets, validation set)
+DATASETS = {}
+
+def init_worker(datasets):
+    """Share the datasets with a worker process.
+    """
+    global DATASETS
+    DATASETS = datasets
+    # One process per core already
+    torch.set_num_threads(1)
+
+def evaluate_config(config):
+    """Train a configuration and return its validation accuracy.
+    """
+    train_sets, (samples, labels) = DATASETS[config["genes_selection"]]
+    model = simulate_walk(train_sets, config)
+    with torch.no_grad():
+        predictions = model(torch.from_numpy(samples)).view(-1).numpy() >= 0.5
+    return config, float(np.mean(predictions == labels))
+
+def pareto_front(profile_df):
+    """Keep, for each delta, the profiles more accurate than all the profiles
+    with a smaller epsilon.
+    """
+    profile_df = profile_df.sort_values(["delta", "epsilon", "acc"], ascending=[True, True, False])
+    best_acc = profile_df.groupby("delta")["acc"].cummax()
+    previous_best = best_acc.groupby(profile_df["delta"]).shift(fill_value=-1.0)
+    return profile_df[profile_df["acc"] > previous_best].reset_index(drop=True)
+
+
+if __name__ == "__main__":
+    args = program_options()
+    deltas = sorted(args.delta)
+
+    # All the configurations, with their epsilons
+    configs = []
+    nb_pruned = 0
+    grid = product(args.genes_selection, args.sample_rate, args.learning_rate, args.fl_rounds,
+                   args.batches_per_round, args.max_grad_norm, args.noise_multiplier)
+    epsilons = {}
+    budget_steps = {}
+    for values in grid:
+        config = dict(zip(CONFIG_KEYS, values))
+        noise_key = (config["sample_rate"], config["noise_multiplier"])
+        if noise_key not in budget_steps:
+            # The epsilon is the smallest for the largest delta
+            budget_steps[noise_key] = steps_for_budget(*noise_key, ALPHAS, args.max_epsilon, deltas[-1])
+        nb_steps = config["fl_rounds"] * config["batches_per_round"]
+        if budget_steps[noise_key] is not None and nb_steps > budget_steps[noise_key]:
+            nb_pruned += 1
+            continue
+        key = noise_key + (nb_steps,)
+        if key not in epsilons:
+            epsilons[key] = compute_epsilons(*key, deltas)
+        configs.append(config)
+    print(f"{len(configs)} configurations to train, {nb_pruned} over the privacy budget.")
+
+    datasets = {}
+    for signature in set(config["genes_selection"] for config in configs):
+        splits = [
+            split_dataset(load_cached_dataset(tumor, normal, signature, 42, args.cache_dir), args.valid_fraction)
+            for tumor, normal in zip(args.train_tumor, args.train_normal)
+        ]
+        train_sets = [train for train, _ in splits]
+        valid_set = tuple(np.concatenate(arrays) for arrays in zip(*[valid for _, valid in splits]))
+        datasets[signature] = (train_sets, valid_set)
+
+    start = time.perf_counter()
+    rows = []
+    with multiprocessing.Pool(args.workers, initializer=init_worker, initargs=(datasets,)) as pool:
+        for config, acc in pool.imap_unordered(evaluate_config, configs, chunksize=16):
+            key = (config["sample_rate"], config["noise_multiplier"], config["fl_rounds"] * config["batches_per_round"])
+            for delta, epsilon in zip(deltas, epsilons[key]):
+                if epsilon <= args.max_epsilon:
+                    rows.append({
+                        "epsilon": epsilon, "delta": delta, "acc": acc, "best_metric": "accuracy",
+                        "network": "lr", "fl_strategy": "walk", **config
+                    })
+    print(f"Trained in {time.perf_counter() - start:.1f}s.")
+
+    profile_df = pareto_front(pd.DataFrame(rows, columns=PROFILE_COLUMNS))
+    profile_df.to_csv(args.output, index=False)
+    print(f"{len(profile_df)} profiles written to {args.output}.")
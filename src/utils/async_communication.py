@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# Copyright 2021 Owkin, inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Model exchanges running in the background of the training loop.
+
+An `AsyncChannel` sends and receives on its own I/O threads, so that local
+steps run while the models are in flight. Frames are the ones of `send` and
+`receive`: the peer can use the blocking functions.
+"""
+import queue
+import threading
+from concurrent.futures import Future
+
+import torch
+
+from .communication import receive, send, count_parameters, load_flat_model
+from .tracing import get_tracer
+
+# Number of buffers per direction: one in flight, one used by the training loop
+NB_BUFFERS = 2
+
+
+class AsyncChannel:
+    """Double-buffered model exchanges on a connection, from background threads.
+
+    Args:
+        conn (socket): Connection to the peer, not to be used by the caller
+            until the channel is closed.
+        model (torch.nn.Module): Model whose parameters are exchanged.
+    """
+
+    def __init__(self, conn, model):
+        self.conn = conn
+        self.size = count_parameters(model)
+        self.send_buffers = queue.Queue()
+        for _ in range(NB_BUFFERS):
+            self.send_buffers.put(torch.empty(self.size))
+        self.receive_buffers = [torch.empty(self.size) for _ in range(NB_BUFFERS)]
+        self.nb_receives = 0
+        self.send_error = None
+
+        self.sends = queue.Queue()
+        self.receives = queue.Queue()
+        self.sender = threading.Thread(target=self._send_loop, daemon=True)
+        self.receiver = threading.Thread(target=self._receive_loop, daemon=True)
+        self.sender.start()
+        self.receiver.start()
+
+    def _send_loop(self):
+        while True:
+            buffer = self.sends.get()
+            if buffer is None:
+                self.sends.task_done()
+                return
+            try:
+                if self.send_error is None:
+                    send(self.conn, buffer)
+            except BaseException as error:
+                self.send_error = error
+            finally:
+                self.send_buffers.put(buffer)
+                self.sends.task_done()
+
+    def _receive_loop(self):
+        while True:
+            request = self.receives.get()
+            if request is None:
+                return
+            future, buffer = request
+            try:
+                future.set_result(receive(self.conn, self.size, buffer))
+            except BaseException as error:
+                future.set_exception(error)
+
+    def _check_send_error(self):
+        if self.send_error is not None:
+            raise self.send_error
+
+    def send_model(self, model):
+        """Copy the model parameters and send them in the background.
+
+        Blocks only when the previous sends still hold both buffers.
+
+        Returns:
+            torch.Tensor: The sent flat parameters, valid until the buffer is
+                reused by a later call.
+        """
+        self._check_send_error()
+        buffer = self.send_buffers.get()
+        with get_tracer().span("send.serialize"):
+            torch.cat([weights.detach().flatten() for weights in model.parameters()], out=buffer)
+        self.sends.put(buffer)
+        return buffer
+
+    def receive_async(self):
+        """Start receiving the next model.
+
+        Returns:
+            Future: Resolves to the received flat parameters. Its buffer is
+                reused `NB_BUFFERS` receptions later.
+        """
+        future = Future()
+        buffer = self.receive_buffers[self.nb_receives % NB_BUFFERS]
+        self.nb_receives += 1
+        self.receives.put((future, buffer))
+        return future
+
+    def receive_model(self, model):
+        """Receive the next model and load it, blocking.
+        """
+        load_flat_model(model, self.receive_async().result())
+
+    def flush(self):
+        """Wait for all the pending sends.
+        """
+        self.sends.join()
+        self._check_send_error()
+
+    def close(self):
+        """Flush, then stop the I/O threads. The connection is left open.
+        """
+        self.flush()
+        self.sends.put(None)
+        self.receives.put(None)
+        self.sender.join()
+        self.receiver.join()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# Copyright 2021 Owkin, inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Lossy encodings of float tensors for the wire.
+
+- fp16: half precision values.
+- int8: symmetric linear quantization, one float32 scale per tensor.
+- topk: the `ratio` largest values in magnitude, with their int32 indices.
+
+All codecs decode to float32.
+"""
+import numpy as np
+import torch
+
+RAW = 0
+FP16 = 1
+INT8 = 2
+TOPK = 3
+CODECS = {"none": RAW, "fp16": FP16, "int8": INT8, "topk": TOPK}
+# Flag of the codec byte: the payload is the difference with the last synced tensor
+DELTA = 0x80
+
+# Indices of the TOPK values, and scale of the INT8 values
+INDEX_DTYPE = np.int32
+SCALE = np.dtype(np.float32)
+
+
+def encode(tensor, codec, topk_ratio=0.01):
+    """Encode a flat float tensor.
+
+    Args:
+        tensor (torch.Tensor): Flat tensor to encode.
+        codec (int): One of FP16, INT8 or TOPK.
+        topk_ratio (float, optional): Share of the values kept by TOPK.
+
+    Returns:
+        (np.ndarray, torch.Tensor): The payload, as a contiguous array, and the
+            float32 tensor the receiver decodes from it.
+    """
+    if codec == FP16:
+        half = tensor.half()
+        return half.numpy(), half.float()
+
+    if codec == INT8:
+        max_abs = tensor.abs().max().item() if tensor.numel() > 0 else 0.0
+        scale = max_abs / 127.0 if max_abs > 0 else 1.0
+        quantized = torch.round(tensor / scale).clamp_(-127, 127).to(torch.int8)
+        payload = np.empty(SCALE.itemsize + quantized.numel(), dtype=np.uint8)
+        payload[:SCALE.itemsize] = np.frombuffer(np.float32(scale).tobytes(), dtype=np.uint8)
+        payload[SCALE.itemsize:] = quantized.numpy().view(np.uint8)
+        return payload, quantized.float().mul_(np.float32(scale))
+
+    if codec == TOPK:
+        k = min(tensor.numel(), max(1, int(round(topk_ratio * tensor.numel()))))
+        indices = torch.topk(tensor.abs(), k, sorted=False).indices
+        values = tensor.index_select(0, indices).float()
+        payload = np.concatenate([
+            indices.numpy().astype(INDEX_DTYPE).view(np.uint8),
+            values.numpy().view(np.uint8),
+        ])
+        decoded = torch.zeros(tensor.numel())
+        decoded.index_copy_(0, indices, values)
+        return payload, decoded
+
+    raise ValueError("Unknown codec %d" % codec)
+
+def decode(codec, payload, nb_elements, out=None):
+    """Decode a payload written by `encode`.
+
+    Args:
+        codec (int): Codec of the payload.
+        payload (np.ndarray): uint8 payload.
+        nb_elements (int): Number of elements of the tensor.
+        out (torch.Tensor, optional): float32 tensor to decode into.
+    """
+    if out is None or out.dtype != torch.float32 or out.numel() != nb_elements:
+        out = torch.empty(nb_elements)
+
+    if codec == FP16:
+        out.copy_(torch.from_numpy(payload.view(np.float16)))
+    elif codec == INT8:
+        scale = payload[:SCALE.itemsize].view(np.float32)[0]
+        out.copy_(torch.from_numpy(payload[SCALE.itemsize:].view(np.int8))).mul_(float(scale))
+    elif codec == TOPK:
+        k = len(payload) // (np.dtype(INDEX_DTYPE).itemsize + 4)
+        split = k * np.dtype(INDEX_DTYPE).itemsize
+        indices = torch.from_numpy(payload[:split].view(INDEX_DTYPE).astype(np.int64))
+        values = torch.from_numpy(payload[split:].view(np.float32))
+        out.zero_().index_copy_(0, indices, values)
+    else:
+        raise ValueError("Unknown codec %d" % codec)
+    return out
@@ -13,13 +13,33 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import selectors
 import socket
 import struct
 import time
+import weakref
 
+import numpy as np
 import torch
 
+from .codecs import CODECS, DELTA, RAW, decode, encode
+from .loopback import LoopbackConnection
+from .tracing import get_tracer
+
 def start_server(port, mode="subprocess"):
+    return accept_clients(port, 1, mode)[0]
+
+def accept_clients(port, nb_clients, mode="subprocess"):
+    """Listen on a port and wait for a given number of clients.
+
+    Args:
+        port (int): Port to listen on.
+        nb_clients (int): Number of clients to accept.
+        mode (str, optional): Launching mode. Defaults to "subprocess".
+
+    Returns:
+        list[socket]: One connection per client, in order of arrival.
+    """
     s = socket.socket()
     if mode == "docker":
         ip_address = socket.gethostbyname(socket.gethostname())
@@ -35,16 +55,23 @@ def start_server(port, mode="subprocess"):
        time.sleep(1)
        s.bind((ip_address, port))
 
-    s.listen(1)
-    c, addr = s.accept()
-    print("Connection from: " + str(addr))
-    return c
+    s.listen(nb_clients)
+    conns = []
+    for _ in range(nb_clients):
+        c, addr = s.accept()
+        # Frames are written as header + payload, do not let Nagle hold them back
+        c.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        print("Connection from: " + str(addr))
+        conns.append(c)
+    s.close()
+    return conns
 
 def start_client(host, port):
     while True:
         try:
             s = socket.socket()
             s.connect((host, port))
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             break
         except socket.error:
             print("Connection Failed, Retrying..")
@@ -52,16 +79,252 @@ def start_client(host, port):
     return s
 
 def stop_server(conn):
-    conn.close()
+    if isinstance(conn, list):
+        for c in conn:
+            c.close()
+    else:
+        conn.close()
 
-def send(conn, message):
-    data = struct.pack('<%df' % len(message),*message)
-    conn.send(data)
+# Every message on the wire is a fixed-size header followed by the payload.
+# The header holds the codec (see utils.codecs), the dtype code and number of
+# elements of the decoded tensor, and the size of the payload in bytes. Raw
+# frames carry the tensor buffer itself.
+HEADER = struct.Struct("<BBQQ")
+# Codec byte of the tensors handed over in memory (utils.loopback), without payload
+HANDOFF = 0x7F
+DTYPES = {
+    0: torch.float32,
+    1: torch.float64,
+    2: torch.float16,
+    3: torch.int8,
+}
+DTYPE_CODES = {dtype: code for code, dtype in DTYPES.items()}
 
-def receive(conn, size_list):
-    data = conn.recv(1024)
-    data = list(struct.unpack('<%df' % size_list ,data))
-    return data
+
+class CodecState:
+    """Encoding of the tensors sent on a connection.
+
+    With delta encoding, the difference with the tensor the receiver decoded
+    from the previous frame is sent, so that the errors of lossy codecs are
+    corrected by the next frames.
+
+    Args:
+        codec (str): "none", "fp16", "int8" or "topk".
+        delta (bool): Send differences with the last synced tensor.
+        topk_ratio (float): Share of the values sent by "topk".
+    """
+    def __init__(self, codec, delta, topk_ratio):
+        self.codec = CODECS[codec]
+        self.delta = delta
+        self.topk_ratio = topk_ratio
+        self.reference = None
+
+    def encode(self, tensor):
+        """Return the codec byte and payload of a flat float tensor.
+        """
+        if not self.delta:
+            return self.codec, encode(tensor, self.codec, self.topk_ratio)[0]
+
+        tensor = tensor.float()
+        if self.reference is None or self.reference.numel() != tensor.numel():
+            self.reference = torch.zeros(tensor.numel())
+        difference = tensor - self.reference
+        if self.codec == RAW:
+            payload, decoded = difference.numpy(), difference
+        else:
+            payload, decoded = encode(difference, self.codec, self.topk_ratio)
+        # Track what the receiver decodes
+        self.reference.add_(decoded)
+        return self.codec | DELTA, payload
+
+# Codec of the tensors sent on each connection, and last tensor decoded from
+# the delta frames received on each connection.
+SEND_CODECS = weakref.WeakKeyDictionary()
+RECEIVE_REFERENCES = weakref.WeakKeyDictionary()
+
+def set_codec(conn, codec="none", delta=False, topk_ratio=0.01):
+    """Set the encoding of the tensors sent on connection(s), and reset their
+    delta encoding state in both directions.
+
+    Top-k sparsification is always delta-encoded.
+
+    Args:
+        conn (socket or list[socket]): Connection(s).
+        codec (str, optional): "none", "fp16", "int8" or "topk". Defaults to "none".
+        delta (bool, optional): Send differences with the last synced tensor.
+            Defaults to False.
+        topk_ratio (float, optional): Share of the values sent by "topk". Defaults to 0.01.
+    """
+    if codec not in CODECS:
+        print("Unknown codec %s." % codec)
+        exit(1)
+    for c in (conn if isinstance(conn, list) else [conn]):
+        SEND_CODECS[c] = CodecState(codec, delta or codec == "topk", topk_ratio)
+        RECEIVE_REFERENCES.pop(c, None)
+
+class FrameReader:
+    """Incremental reader of one frame, fed as data arrives on the connection.
+
+    Args:
+        conn (socket): Connection to read from.
+        size_list (int): Expected number of elements.
+        out (torch.Tensor, optional): Preallocated flat tensor to receive into.
+    """
+    def __init__(self, conn, size_list, out=None):
+        self.conn = conn
+        self.size_list = size_list
+        self.out = out
+        self.header = bytearray(HEADER.size)
+        self.view = memoryview(self.header)
+        self.idx = 0
+        self.in_payload = False
+
+    def read(self):
+        """Read the available bytes, return True once the frame is complete.
+        """
+        nb_bytes = self.conn.recv_into(self.view[self.idx:])
+        if nb_bytes == 0:
+            print("Connection closed by peer.")
+            exit(1)
+        self.idx += nb_bytes
+        if self.idx < len(self.view):
+            return False
+        if self.in_payload:
+            return self.finish()
+
+        self.codec, dtype_code, nb_elements, nb_bytes = HEADER.unpack(self.header)
+        if nb_elements != self.size_list or dtype_code not in DTYPES:
+            print("Unexpected message of %d elements (dtype code %d), expected %d." % (
+                nb_elements, dtype_code, self.size_list))
+            exit(1)
+        dtype = DTYPES[dtype_code]
+        if self.codec == HANDOFF:
+            self.out = self.conn.receive_tensor()
+            self.view = memoryview(b"")
+            self.in_payload = True
+            return True
+        if self.codec == RAW:
+            # Receive in place
+            if self.out is None or self.out.dtype != dtype or self.out.numel() != nb_elements:
+                self.out = torch.empty(nb_elements, dtype=dtype)
+            self.view = memoryview(self.out.numpy()).cast("B")
+        else:
+            self.payload = np.empty(nb_bytes, dtype=np.uint8)
+            self.view = memoryview(self.payload)
+        if len(self.view) != nb_bytes:
+            print("Unexpected payload of %d bytes, expected %d." % (nb_bytes, len(self.view)))
+            exit(1)
+        self.idx = 0
+        self.in_payload = True
+        return self.finish() if len(self.view) == 0 else False
+
+    def finish(self):
+        """Decode the payload of a complete frame.
+        """
+        if self.codec == RAW:
+            return True
+        with get_tracer().span("receive.decode"):
+            codec = self.codec & ~DELTA
+            if codec == RAW:
+                decoded = torch.from_numpy(self.payload.view(np.float32))
+            else:
+                decoded = decode(codec, self.payload, self.size_list, self.out)
+            if self.codec & DELTA:
+                reference = RECEIVE_REFERENCES.get(self.conn)
+                if reference is None or reference.numel() != self.size_list:
+                    reference = torch.zeros(self.size_list)
+                    RECEIVE_REFERENCES[self.conn] = reference
+                reference.add_(decoded)
+                decoded = reference
+            if self.out is None or self.out.dtype != torch.float32 or self.out.numel() != self.size_list:
+                self.out = torch.empty(self.size_list)
+            if decoded is not self.out:
+                self.out.copy_(decoded)
+        return True
+
+def send(conn, tensor):
+    """Send a tensor as a header followed by its payload, encoded with the codec
+    of the connection (see `set_codec`), or raw.
+
+    Args:
+        conn (socket): Connection to write to.
+        tensor (torch.Tensor): Tensor to send, it is flattened.
+    """
+    tensor = tensor.detach().cpu().contiguous().view(-1)
+    state = SEND_CODECS.get(conn)
+    if state is None or (state.codec == RAW and not state.delta) or not tensor.is_floating_point():
+        if isinstance(conn, LoopbackConnection):
+            # Same process: hand over a copy, the caller may reuse its tensor
+            with get_tracer().span("send.handoff"):
+                conn.send_tensor(HEADER.pack(HANDOFF, DTYPE_CODES[tensor.dtype], tensor.numel(), 0), tensor.clone())
+            return
+        codec, payload = RAW, tensor.numpy()
+        dtype_code = DTYPE_CODES[tensor.dtype]
+    else:
+        with get_tracer().span("send.encode"):
+            codec, payload = state.encode(tensor)
+        dtype_code = DTYPE_CODES[torch.float32]
+    payload = memoryview(payload).cast("B")
+    with get_tracer().span("send.network", bytes=HEADER.size + len(payload)):
+        conn.sendall(HEADER.pack(codec, dtype_code, tensor.numel(), len(payload)))
+        conn.sendall(payload)
+
+def receive(conn, size_list, out=None):
+    """Receive a tensor sent with `send`.
+
+    Args:
+        conn (socket): Connection to read from.
+        size_list (int): Expected number of elements.
+        out (torch.Tensor, optional): Preallocated flat tensor to receive into.
+    """
+    reader = FrameReader(conn, size_list, out)
+    with get_tracer().span("receive.network") as trace_args:
+        while not reader.read():
+            pass
+        trace_args["bytes"] = HEADER.size + len(reader.view)
+    return reader.out
+
+def receive_all(conns, size_list, outs=None):
+    """Receive one tensor from each connection, reading them as data arrives.
+
+    Args:
+        conns (list[socket]): Connections to read from.
+        size_list (int): Expected number of elements of each tensor.
+        outs (list[torch.Tensor], optional): Preallocated flat tensors to receive into.
+    """
+    if outs is None:
+        outs = [None] * len(conns)
+    readers = [FrameReader(conn, size_list, out) for conn, out in zip(conns, outs)]
+    if not all(isinstance(conn, socket.socket) for conn in conns):
+        # In-memory connections (utils.loopback) cannot be polled, read in order
+        with get_tracer().span("receive.network", peers=len(conns)) as trace_args:
+            for reader in readers:
+                while not reader.read():
+                    pass
+            trace_args["bytes"] = sum(HEADER.size + len(reader.view) for reader in readers)
+        return [reader.out for reader in readers]
+
+    selector = selectors.DefaultSelector()
+    for reader in readers:
+        selector.register(reader.conn, selectors.EVENT_READ, reader)
+    pending = len(readers)
+    with get_tracer().span("receive.network", peers=len(conns)) as trace_args:
+        while pending > 0:
+            for key, _ in selector.select():
+                if key.data.read():
+                    selector.unregister(key.fileobj)
+                    pending -= 1
+        trace_args["bytes"] = sum(HEADER.size + len(reader.view) for reader in readers)
+    selector.close()
+    return [reader.out for reader in readers]
+
+def send_flag(conn, flag):
+    """Send a boolean, as a one-element int8 tensor.
+    """
+    send(conn, torch.tensor([int(flag)], dtype=torch.int8))
+
+def receive_flag(conn):
+    return bool(receive(conn, 1)[0])
 
 def send_ack(conn):
     message = "ok"
@@ -73,29 +336,62 @@ def receive_ack(conn):
         print("Unrecognized acknowledgement.")
         exit(1)
 
-def send_model(conn, model):
-    data = torch.cat([weights.flatten() for weights in model.parameters()])
-    send(conn, data.tolist())
+def flatten_model(model):
+    return torch.cat([weights.detach().flatten() for weights in model.parameters()])
 
-def receive_model(conn, model, action):
-    nb_params = 0
-    for w in model.parameters():
-        nb_params += w.numel()
-    data = receive(conn, nb_params)
-    weights = []
+def load_flat_model(model, data):
     idx = 0
     for w in model.parameters():
-        weights.append(torch.FloatTensor(data[idx: idx+ w.numel()]).view(w.shape))
+        w.data.copy_(data[idx: idx + w.numel()].view(w.shape))
         idx += w.numel()
-    if action == "overwrite":
-        for w_new, w_old in zip(weights, model.parameters()):
-            w_old.data.copy_(w_new)
-    elif action == "aggregate":
-        w_agg = [
-            0.5 * (w_received + w_local) for w_received, w_local in zip(weights, model.parameters())
-        ]
-        for w_new, w_old in zip(w_agg, model.parameters()):
-            w_old.data.copy_(w_new)
-    else:
-        print("Unknown action %s" % action)
-        exit(1)
+
+def count_parameters(model):
+    nb_params = 0
+    for w in model.parameters():
+        nb_params += w.numel()
+    return nb_params
+
+def send_model(conn, model):
+    with get_tracer().span("send.serialize"):
+        data = flatten_model(model)
+    send(conn, data)
+
+def send_model_all(conns, model):
+    with get_tracer().span("send.serialize"):
+        data = flatten_model(model)
+    for conn in conns:
+        send(conn, data)
+
+def receive_model(conn, model, action, out=None):
+    data = receive(conn, count_parameters(model), out)
+    with get_tracer().span("receive.deserialize", action=action):
+        weights = []
+        idx = 0
+        for w in model.parameters():
+            weights.append(data[idx: idx + w.numel()].view(w.shape))
+            idx += w.numel()
+        if action == "overwrite":
+            for w_new, w_old in zip(weights, model.parameters()):
+                w_old.data.copy_(w_new)
+        elif action == "aggregate":
+            for w_received, w_local in zip(weights, model.parameters()):
+                w_local.data.add_(w_received).mul_(0.5)
+        else:
+            print("Unknown action %s" % action)
+            exit(1)
+    return data
+
+def aggregate_models(conns, model, outs=None):
+    """Receive a model from each connection and average them with the local one.
+
+    Returns:
+        list[torch.Tensor]: Reception buffers, to be reused for the next call.
+    """
+    outs = receive_all(conns, count_parameters(model), outs)
+    with get_tracer().span("receive.deserialize", action="aggregate"):
+        data = flatten_model(model)
+        for received in outs:
+            data.add_(received)
+        data.div_(len(outs) + 1)
+        load_flat_model(model, data)
+    return outs
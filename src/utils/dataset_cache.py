@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# Copyright 2021 Owkin, inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""On-disk cache of parsed training datasets.
+
+Parsing a full TCGA file and selecting the signature genes dominates the
+startup of a training run. The selected float32 matrix and the labels are
+stored once as `.npy` files, keyed by the content of the input files, the
+gene signature and the shuffling seed, and memory-mapped on later runs.
+
+Input files are hashed once: their digest is stored in the cache, keyed by
+their path, size and modification time.
+"""
+import hashlib
+import os
+import pathlib
+import shutil
+import tempfile
+
+import numpy as np
+
+from .expression_matrix import is_expression_matrix, matrix_files
+from .format_data import create_dataset_without_split, create_signature_dataset_without_split
+from .genes_selection import get_genome_signature
+
+DEFAULT_CACHE_DIR = str(pathlib.Path.home().joinpath(".cache", "owkin-submission"))
+# Bump when the layout of a cache entry, or the features built from the data files, change
+CACHE_VERSION = "2"
+# Subdirectory of the cache holding the digests of the input files
+DIGESTS_DIR = "digests"
+SAMPLES_FILE = "samples.npy"
+LABELS_FILE = "labels.npy"
+GENES_FILE = "genes.txt"
+
+
+def file_digest(file_path, chunk_size=1 << 20):
+    """Return the SHA-256 hex digest of a file, read in chunks.
+
+    Args:
+        file_path (str): Path to the file to hash.
+        chunk_size (int, optional): Read size in bytes. Defaults to 1MiB.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as file_reader:
+        for chunk in iter(lambda: file_reader.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def data_files(data_path):
+    """Return the files of a data file or expression matrix.
+    """
+    return matrix_files(data_path) if is_expression_matrix(data_path) else [data_path]
+
+def data_digest(data_path, cache_dir=None):
+    """Return the digest of a data file, or of the files of an expression matrix.
+
+    Args:
+        data_path (str): Data file or expression matrix.
+        cache_dir (str, optional): Cache directory where the digest is stored,
+            keyed by the path, size and modification time of the files. None
+            to always hash the files.
+    """
+    files = data_files(data_path)
+    digest_file = None
+    if cache_dir is not None:
+        stats = [(os.path.abspath(file_path), os.stat(file_path)) for file_path in files]
+        stat_key = repr([(path, stat.st_size, stat.st_mtime_ns) for path, stat in stats])
+        digest_file = os.path.join(cache_dir, DIGESTS_DIR, hashlib.sha256(stat_key.encode("utf-8")).hexdigest())
+        try:
+            with open(digest_file, "r") as file_reader:
+                return file_reader.read()
+        except OSError:
+            pass
+
+    if len(files) == 1:
+        digest = file_digest(files[0])
+    else:
+        digest = hashlib.sha256("-".join(file_digest(file_path) for file_path in files).encode("utf-8")).hexdigest()
+
+    if digest_file is not None:
+        try:
+            os.makedirs(os.path.dirname(digest_file), exist_ok=True)
+            # Write then rename, so that a concurrent run never reads a partial digest
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(digest_file), suffix=".tmp")
+            with os.fdopen(fd, "w") as file_writer:
+                file_writer.write(digest)
+            os.replace(tmp_path, digest_file)
+        except OSError:
+            # The stored digest is an optimization only
+            pass
+    return digest
+
+def dataset_key(tumor_csv_file, normal_csv_file, signature, seed_shuffle, cache_dir=None):
+    """Return the cache key of a dataset.
+
+    Args:
+        tumor_csv_file (str): Path to the tumor data file.
+        normal_csv_file (str): Path to the normal data file.
+        signature (str): Gene signature, "None" for no selection.
+        seed_shuffle (int): Seed used to shuffle the samples.
+        cache_dir (str, optional): Cache directory storing the digests of the
+            data files. Defaults to None.
+    """
+    key = "-".join([
+        CACHE_VERSION,
+        data_digest(tumor_csv_file, cache_dir),
+        data_digest(normal_csv_file, cache_dir),
+        str(signature),
+        str(seed_shuffle),
+    ])
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+def build_dataset(tumor_csv_file, normal_csv_file, signature, seed_shuffle=42):
+    """Parse the data files and select the signature genes.
+
+    Returns:
+        (np.ndarray, np.ndarray, list[str]): float32 samples, float32 labels
+            and the ordered list of genes (columns of the samples).
+    """
+    if signature == "None":
+        X, y = create_dataset_without_split(tumor_csv_file, normal_csv_file, seed_shuffle)
+        return X.to_numpy(dtype="float32"), y.astype("float32"), X.keys().tolist()
+
+    X, y, genes = create_signature_dataset_without_split(
+        tumor_csv_file,
+        normal_csv_file,
+        get_genome_signature(signature),
+        seed_shuffle
+    )
+    return X, y.astype("float32"), genes
+
+def load_cached_dataset(tumor_csv_file, normal_csv_file, signature, seed_shuffle=42,
+                        cache_dir=DEFAULT_CACHE_DIR):
+    """Load a training dataset, from the cache when possible.
+
+    Args:
+        tumor_csv_file (str): Path to the tumor data file.
+        normal_csv_file (str): Path to the normal data file.
+        signature (str): Gene signature, "None" for no selection.
+        seed_shuffle (int, optional): Seed used to shuffle the samples. Defaults to 42.
+        cache_dir (str, optional): Cache directory, "None" or None disables the cache.
+
+    Returns:
+        (np.ndarray, np.ndarray, list[str]): float32 samples (memory-mapped on
+            a cache hit), float32 labels and the ordered list of genes.
+    """
+    if cache_dir in (None, "None"):
+        return build_dataset(tumor_csv_file, normal_csv_file, signature, seed_shuffle)
+
+    entry_dir = os.path.join(
+        cache_dir,
+        dataset_key(tumor_csv_file, normal_csv_file, signature, seed_shuffle, cache_dir)
+    )
+    if not os.path.isdir(entry_dir):
+        samples, labels, genes = build_dataset(tumor_csv_file, normal_csv_file, signature, seed_shuffle)
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write in a temporary directory then rename, so that a concurrent or
+        # interrupted run never sees a partial entry.
+        tmp_dir = tempfile.mkdtemp(dir=cache_dir)
+        np.save(os.path.join(tmp_dir, SAMPLES_FILE), samples)
+        np.save(os.path.join(tmp_dir, LABELS_FILE), labels)
+        with open(os.path.join(tmp_dir, GENES_FILE), "w") as file_writer:
+            file_writer.write("\n".join(genes))
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # Another process stored the same entry in the meantime
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        return samples, labels, genes
+
+    samples = np.load(os.path.join(entry_dir, SAMPLES_FILE), mmap_mode="r")
+    labels = np.load(os.path.join(entry_dir, LABELS_FILE))
+    with open(os.path.join(entry_dir, GENES_FILE), "r") as file_reader:
+        genes = file_reader.read().split("\n")
+    return samples, labels, genes
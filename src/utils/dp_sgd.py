@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# Copyright 2021 Owkin, inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""DP-SGD step of the logistic regression model in closed form.
+
+With a BCE loss, the gradient of the loss of sample `i` with respect to the
+weights and bias of `LogisticRegression` is `(sigmoid(x_i.w + b) - y_i) * [x_i, 1]`.
+Per-sample gradients, their norms, clipping and noise are then a few batched
+tensor operations, without the autograd hooks of opacus.
+
+The step follows the `PrivacyEngine` of opacus: flat clipping to
+`max_grad_norm`, Gaussian noise of standard deviation
+`noise_multiplier * max_grad_norm` on each parameter, averaging over the batch
+(mean loss), and the same RDP accounting.
+"""
+import torch
+from .privacy_accountant import PrivacyAccountant
+
+
+class LogisticRegressionDPSGD:
+    """DP-SGD optimizer of a `LogisticRegression` model.
+
+    Args:
+        model (LogisticRegression): Model to train, updated in place.
+        lr (float): Learning rate.
+        sample_rate (float): Probability of each sample to be in a batch.
+        noise_multiplier (float): (DP) Noise multiplier.
+        max_grad_norm (float): (DP) Clipping threshold.
+        alphas (list[float]): RDP orders of the privacy accounting.
+        target_delta (float, optional): (DP) Target delta. Defaults to None.
+        secure_rng (bool, optional): Draw the noise from a CSPRNG (torchcsprng).
+            Defaults to False.
+        generator (torch.Generator, optional): Generator of the noise without
+            `secure_rng`. Defaults to the global generator.
+    """
+
+    def __init__(self, model, lr, sample_rate, noise_multiplier, max_grad_norm, alphas,
+                 target_delta=None, secure_rng=False, generator=None):
+        self.model = model
+        self.lr = lr
+        self.sample_rate = sample_rate
+        self.noise_multiplier = noise_multiplier
+        self.max_grad_norm = max_grad_norm
+        self.alphas = alphas
+        self.target_delta = target_delta
+        self.steps = 0
+        self.accountant = PrivacyAccountant(sample_rate, noise_multiplier, alphas, target_delta)
+
+        if secure_rng:
+            import torchcsprng
+
+            self.random_number_generator = torchcsprng.create_random_device_generator("/dev/urandom")
+        else:
+            self.random_number_generator = generator
+
+    @torch.no_grad()
+    def step(self, x, y):
+        """Take one DP-SGD step on a batch.
+
+        Args:
+            x (torch.Tensor): Samples of the batch.
+            y (torch.Tensor): Labels of the batch.
+        """
+        self.steps += 1
+        self.accountant.step()
+        weight = self.model.linear.weight
+        bias = self.model.linear.bias
+
+        # Derivative of each sample loss with respect to the logit
+        residuals = torch.sigmoid(torch.addmm(bias, x, weight.t())) - y.view(-1, 1)
+
+        # Norm of [residual * x, residual], then flat clipping as opacus
+        norms = residuals.abs().view(-1) * (x.pow(2).sum(dim=1) + 1).sqrt()
+        clip_factors = (self.max_grad_norm / (norms + 1e-6)).clamp(max=1.0)
+        coefficients = residuals * clip_factors.view(-1, 1)
+
+        # Empty batches only get noise
+        batch_size = max(len(x), 1)
+        for param, summed_grad in [(weight, coefficients.t().mm(x)), (bias, coefficients.sum(dim=0))]:
+            if self.noise_multiplier > 0:
+                summed_grad += torch.normal(
+                    0,
+                    self.noise_multiplier * self.max_grad_norm,
+                    param.shape,
+                    generator=self.random_number_generator,
+                )
+            param.sub_(summed_grad, alpha=self.lr / batch_size)
+
+    def get_privacy_spent(self, target_delta=None):
+        """Return the (epsilon, best alpha) privacy budget spent so far.
+
+        Args:
+            target_delta (float, optional): Defaults to the target delta of the optimizer.
+        """
+        return self.accountant.get_privacy_spent(target_delta)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# Copyright 2021 Owkin, inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Early stopping of the walk training, decided by the server.
+
+After each round, the server checks whether the next round would exceed the
+(epsilon, delta) budget of the training, and whether the loss on samples it
+holds out has stopped improving. The decision is sent to all the clients, so
+that every participant stops after the same round.
+"""
+import torch
+
+from .privacy_accountant import steps_for_budget
+
+
+class EarlyStopping:
+    """Stopping rule of a training, evaluated by the server before each round.
+
+    Args:
+        steps_per_round (int): Steps taken by each participant per round.
+        sample_rate (float, optional): (DP) Probability of each sample to be in a batch.
+        noise_multiplier (float, optional): (DP) Noise multiplier.
+        alphas (list[float], optional): RDP orders of the privacy accounting.
+        epsilon (float, optional): (DP) Budget to stay within, None to ignore it.
+        delta (float, optional): (DP) Delta of the budget.
+        validation_set (tuple[torch.Tensor, torch.Tensor], optional): Held-out
+            samples and labels, None to ignore the validation loss.
+        patience (int, optional): Rounds without improvement of the validation
+            loss before stopping. Defaults to 3.
+        min_delta (float, optional): Smallest decrease of the validation loss
+            counted as an improvement. Defaults to 0.
+    """
+
+    def __init__(self, steps_per_round, sample_rate=None, noise_multiplier=None, alphas=None,
+                 epsilon=None, delta=None, validation_set=None, patience=3, min_delta=0.0):
+        self.steps_per_round = steps_per_round
+        self.max_steps = None
+        if epsilon is not None:
+            self.max_steps = steps_for_budget(sample_rate, noise_multiplier, alphas, epsilon, delta)
+        self.validation_set = validation_set
+        self.patience = patience
+        self.min_delta = min_delta
+
+        self.best_loss = float("inf")
+        self.nb_bad_rounds = 0
+        self.rounds = 0
+        self.stop_reason = None
+
+    def budget_allows(self, nb_rounds):
+        """Return whether `nb_rounds` rounds fit in the privacy budget.
+        """
+        return self.max_steps is None or nb_rounds * self.steps_per_round <= self.max_steps
+
+    def validation_loss(self, model, criterion):
+        samples, labels = self.validation_set
+        with torch.no_grad():
+            return float(criterion(model(samples), labels.view(-1, 1)))
+
+    def should_stop(self, model, criterion):
+        """Return whether to stop the training before its next round, `rounds`
+        rounds being done.
+
+        The budget is checked before every round, the first one included; the
+        validation loss once a round has been trained.
+        """
+        if not self.budget_allows(self.rounds + 1):
+            self.stop_reason = "budget"
+            return True
+        if self.validation_set is not None and self.rounds > 0:
+            loss = self.validation_loss(model, criterion)
+            if loss < self.best_loss - self.min_delta:
+                self.best_loss = loss
+                self.nb_bad_rounds = 0
+            else:
+                self.nb_bad_rounds += 1
+                if self.nb_bad_rounds >= self.patience:
+                    self.stop_reason = "validation"
+                    return True
+        return False
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# Copyright 2021 Owkin, inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Binary expression matrices.
+
+An expression matrix is a directory holding the float32 values, as a `.npy`
+file with one row per gene (the layout of the text data files, one gene after
+another), and the gene and sample names as text files. The values are
+memory-mapped on load, so that no stage re-parses the data, and the rows of a
+gene signature are read without touching the other genes.
+"""
+import os
+
+import numpy as np
+
+MATRIX_SUFFIX = ".expr"
+VALUES_FILE = "values.npy"
+GENES_FILE = "genes.txt"
+SAMPLES_FILE = "samples.txt"
+
+
+def is_expression_matrix(path):
+    """Return whether a path is an expression matrix rather than a text data file.
+    """
+    return os.path.isfile(os.path.join(path, VALUES_FILE))
+
+def save_expression_matrix(path, values, genes, samples):
+    """Save an expression matrix.
+
+    Args:
+        path (str): Output directory, created if needed.
+        values (np.ndarray): Values, one row per gene and one column per sample.
+        genes (list[str]): Gene names.
+        samples (list[str]): Sample identifiers.
+    """
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, VALUES_FILE), np.ascontiguousarray(values, dtype=np.float32))
+    for file_name, names in [(GENES_FILE, genes), (SAMPLES_FILE, samples)]:
+        with open(os.path.join(path, file_name), "w") as file_writer:
+            file_writer.write("\n".join(names))
+
+def load_expression_matrix(path, mmap_mode="r"):
+    """Load an expression matrix.
+
+    Args:
+        path (str): Matrix directory.
+        mmap_mode (str, optional): Memory-mapping mode of the values, None to
+            read them in memory. Defaults to "r".
+
+    Returns:
+        (np.ndarray, list[str], list[str]): float32 values (gene x sample),
+            gene names and sample identifiers.
+
+    Raises:
+        ValueError: If the shape of the values does not match the names.
+    """
+    names = []
+    for file_name in [GENES_FILE, SAMPLES_FILE]:
+        with open(os.path.join(path, file_name), "r") as file_reader:
+            content = file_reader.read()
+        names.append(content.split("\n") if content else [])
+    values = np.load(os.path.join(path, VALUES_FILE), mmap_mode=mmap_mode)
+    if values.shape != (len(names[0]), len(names[1])):
+        raise ValueError("Expression matrix %s: values of shape %s for %d genes and %d samples." % (
+            path, values.shape, len(names[0]), len(names[1])))
+    return values, names[0], names[1]
+
+def matrix_files(path):
+    """Return the files of an expression matrix.
+    """
+    return [os.path.join(path, file_name) for file_name in [VALUES_FILE, GENES_FILE, SAMPLES_FILE]]
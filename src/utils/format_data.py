@@ -13,11 +13,23 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from pandas import concat, read_csv
+import numpy as np
+from pandas import concat, read_csv, DataFrame, Index
+
+from .expression_matrix import is_expression_matrix, load_expression_matrix, save_expression_matrix
 
 GENES_COL_NAME="Hybridization REF"
+# Strings parsed as missing values, same as the pandas defaults
+NA_VALUES = {
+    "", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND",
+    "1.#QNAN", "<NA>", "N/A", "NA", "NULL", "NaN", "n/a", "nan", "null"
+}
 
 def format_data(input_csv_path):
+    if is_expression_matrix(input_csv_path):
+        values, genes, samples = load_expression_matrix(input_csv_path)
+        return DataFrame(values.T, index=samples, columns=Index(genes, name=GENES_COL_NAME), copy=False)
+
     data = read_csv(input_csv_path, sep="\t")
     header = data[GENES_COL_NAME]
     data.drop([GENES_COL_NAME], axis="columns", inplace=True)
@@ -25,6 +37,187 @@ def format_data(input_csv_path):
     data.columns = header
     return data
 
+def parse_values(line):
+    """Parse the tab-separated values of a data row, missing values are set to 0.
+    """
+    return parse_fields(line.rstrip("\r\n").split("\t"))
+
+def parse_fields(fields):
+    """Parse the value fields of a data row, missing values are set to 0.
+    """
+    try:
+        values = np.asarray(fields, dtype=np.float64)
+    except ValueError:
+        values = np.asarray(
+            ["nan" if field.strip() in NA_VALUES else field for field in fields],
+            dtype=np.float64
+        )
+    values[np.isnan(values)] = 0
+    return values.astype(np.float32)
+
+def format_signature_data(input_csv_path, genes):
+    """Stream a gene data file and only keep the rows of the requested genes.
+
+    The whole file is never materialized: each line is matched on its gene
+    name and only the selected rows are parsed, so memory and parsing time
+    scale with the signature size rather than the genome size.
+
+    Args:
+        input_csv_path (str): Gene data file (tab-separated, one row per gene),
+            or expression matrix.
+        genes (iterable[str]): Genes to keep. Genes absent from the file are ignored,
+            all the rows of a duplicated gene are kept, as with `format_data`.
+
+    Returns:
+        (dict[str, list[np.ndarray]], list[str]): float32 values of the rows of
+            each found gene (one value per sample), in file order, and the
+            sample identifiers.
+    """
+    genes = set(genes)
+    rows = {}
+    if is_expression_matrix(input_csv_path):
+        # Contiguous rows of the memory-mapped matrix, nothing to parse
+        values, file_genes, samples = load_expression_matrix(input_csv_path)
+        for idx, gene in enumerate(file_genes):
+            if gene in genes:
+                rows.setdefault(gene, []).append(values[idx])
+        return rows, samples
+
+    with open(input_csv_path, "r") as file_reader:
+        header = file_reader.readline().rstrip("\r\n").split("\t")
+        for line in file_reader:
+            gene, _, values = line.partition("\t")
+            if gene in genes:
+                rows.setdefault(gene, []).append(parse_values(values))
+    return rows, header[1:]
+
+def parse_data_file(input_csv_path):
+    """Parse a whole gene data file, streaming its rows. Missing values are set to 0.
+
+    Returns:
+        (np.ndarray, list[str], list[str]): float32 values (gene x sample),
+            gene names and sample identifiers.
+    """
+    genes, rows = [], []
+    with open(input_csv_path, "r") as file_reader:
+        samples = file_reader.readline().rstrip("\r\n").split("\t")[1:]
+        for line in file_reader:
+            gene, _, values = line.partition("\t")
+            genes.append(gene)
+            rows.append(parse_values(values))
+    values = np.stack(rows) if rows else np.empty((0, len(samples)), dtype=np.float32)
+    return values, genes, samples
+
+def convert_to_expression_matrix(input_csv_path, output_path):
+    """Convert a gene data file to an expression matrix.
+
+    Args:
+        input_csv_path (str): Gene data file (tab-separated, one row per gene).
+        output_path (str): Output matrix directory.
+    """
+    save_expression_matrix(output_path, *parse_data_file(input_csv_path))
+
+def read_fields(file_reader, offset, nb_fields):
+    """Read the next tab-separated fields of a row of a binary file.
+
+    Args:
+        file_reader (file): File opened in binary mode.
+        offset (int): Offset of the first field to read.
+        nb_fields (int): Number of fields to read, fewer if the row ends first.
+
+    Returns:
+        (list[str], int): The fields, and the offset of the field after them.
+    """
+    file_reader.seek(offset)
+    # About 16 bytes per value, then more if the values are longer
+    data = bytearray(file_reader.read(16 * nb_fields + 64))
+    while True:
+        end = data.find(b"\n")
+        row = data if end < 0 else data[:end]
+        fields = row.split(b"\t", nb_fields)
+        if len(fields) > nb_fields:
+            # Skip the separator after the last field read
+            return [field.decode("utf-8") for field in fields[:-1]], offset + len(row) - len(fields[-1])
+        if end >= 0:
+            return [field.decode("utf-8").rstrip("\r") for field in fields], offset + end
+        block = file_reader.read(max(len(data), 4096))
+        if not block:
+            return [field.decode("utf-8").rstrip("\r") for field in fields], offset + len(data)
+        data += block
+
+class TestChunkReader:
+    """Read the samples of a test data file by chunks of columns, restricted
+    to selected genes.
+
+    Only the offsets of the gene rows are kept in memory. A pass over the
+    samples keeps a cursor in the row of each selected gene: each chunk reads
+    and parses only its own fields, so that every row is read once per pass.
+    Expression matrices are sliced from their memory map.
+
+    Args:
+        data_file (str): Gene data file (tab-separated, one row per gene), or
+            expression matrix.
+    """
+    def __init__(self, data_file):
+        self.data_file = data_file
+        if is_expression_matrix(data_file):
+            self.values, self.genes, self.samples = load_expression_matrix(data_file)
+            return
+        self.values = None
+        self.offsets = []
+        self.genes = []
+        # Binary mode, for offsets that can be seeked to
+        with open(data_file, "rb") as file_reader:
+            self.samples = file_reader.readline().decode("utf-8").rstrip("\r\n").split("\t")[1:]
+            offset = file_reader.tell()
+            for line in file_reader:
+                self.genes.append(line.partition(b"\t")[0].decode("utf-8"))
+                self.offsets.append(offset)
+                offset += len(line)
+
+    def gene_indices(self, genes):
+        """Return the row index of each of the given genes, -1 if absent.
+
+        The first row of a duplicated gene is used.
+        """
+        positions = {}
+        for idx, gene in enumerate(self.genes):
+            positions.setdefault(gene, idx)
+        return np.array([positions.get(gene, -1) for gene in genes], dtype=np.int64)
+
+    def iter_chunks(self, genes, chunk_size):
+        """Iterate over the samples by chunks.
+
+        Args:
+            genes (list[str]): Ordered genes to select, all present in the file.
+            chunk_size (int): Number of samples per chunk.
+
+        Yields:
+            (list[str], np.ndarray): Identifiers and float32 values (sample x
+                gene) of the samples of a chunk.
+        """
+        indices = self.gene_indices(genes)
+        if (indices < 0).any():
+            raise KeyError("Genes missing from %s: %s" % (
+                self.data_file, ", ".join(gene for gene, idx in zip(genes, indices) if idx < 0)))
+
+        if self.values is not None:
+            for start in range(0, len(self.samples), chunk_size):
+                end = min(start + chunk_size, len(self.samples))
+                yield self.samples[start:end], np.asarray(self.values[indices, start:end].T, dtype=np.float32)
+            return
+
+        # Offset of the next value of each selected row, starting past the gene name
+        cursors = [self.offsets[idx] + len(self.genes[idx].encode("utf-8")) + 1 for idx in indices.tolist()]
+        with open(self.data_file, "rb") as file_reader:
+            for start in range(0, len(self.samples), chunk_size):
+                end = min(start + chunk_size, len(self.samples))
+                X = np.empty((end - start, len(indices)), dtype=np.float32)
+                for column in range(len(indices)):
+                    fields, cursors[column] = read_fields(file_reader, cursors[column], end - start)
+                    X[:, column] = parse_fields(fields)
+                yield self.samples[start:end], X
+
 def create_test_dataset_without_split(data_file):
     """Create an ML-ready dataset from a gene data file.
 
@@ -60,3 +253,45 @@ def create_dataset_without_split(tumor_csv_file, normal_csv_file, seed_shuffle=4
     X = X.fillna(0)
     return X, y
 
+def create_signature_dataset_without_split(tumor_csv_file, normal_csv_file, genes, seed_shuffle=42):
+    """Streaming equivalent of `create_dataset_without_split` followed by
+    `genes_selection_extraction`.
+
+    Samples are shuffled in the same order and genes are sorted, so the
+    result matches the DataFrame-based pipeline.
+
+    Args:
+        tumor_csv_file (str): Path to the tumor data file.
+        normal_csv_file (str): Path to the normal data file.
+        genes (iterable[str]): Genes of the signature.
+        seed_shuffle (int, optional): Seed used to shuffle the samples. Defaults to 42.
+
+    Returns:
+        (np.ndarray, np.ndarray, list[str]): float32 samples (sample x gene),
+            labels and the ordered list of selected genes.
+    """
+    rows_tumor, samples_tumor = format_signature_data(tumor_csv_file, genes)
+    rows_normal, samples_normal = format_signature_data(normal_csv_file, genes)
+    # A duplicated gene gives one column per row, as DataFrame column selection
+    selected_genes = [
+        gene
+        for gene in sorted(set(rows_tumor) | set(rows_normal))
+        for _ in range(max(len(rows_tumor.get(gene, [])), len(rows_normal.get(gene, []))))
+    ]
+
+    nb_tumor = len(samples_tumor)
+    X = np.zeros((nb_tumor + len(samples_normal), len(selected_genes)), dtype=np.float32)
+    occurrences = {}
+    for idx, gene in enumerate(selected_genes):
+        occurrence = occurrences.get(gene, 0)
+        occurrences[gene] = occurrence + 1
+        if occurrence < len(rows_tumor.get(gene, [])):
+            X[:nb_tumor, idx] = rows_tumor[gene][occurrence]
+        if occurrence < len(rows_normal.get(gene, [])):
+            X[nb_tumor:, idx] = rows_normal[gene][occurrence]
+    y = np.zeros(len(X), dtype=np.int64)
+    y[:nb_tumor] = 1
+
+    # Same permutation as DataFrame.sample(frac=1, random_state=seed_shuffle)
+    permutation = np.random.RandomState(seed_shuffle).choice(len(X), size=len(X), replace=False)
+    return X[permutation], y[permutation], selected_genes
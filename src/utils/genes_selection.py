@@ -69,3 +69,21 @@ def genes_selection_extraction(X_train, signature):
     X_train = X_train[selected_genes]
     return X_train
 
+def genes_selection_indices(X, genes):
+    """Return the integer column index of each of the given genes.
+
+    Args:
+        X (DataFrame): Dataset with one column per gene.
+        genes (list[str]): Ordered genes to select.
+    """
+    indices = X.columns.get_indexer(genes)
+    if (indices < 0).any():
+        missing = [gene for gene, idx in zip(genes, indices) if idx < 0]
+        print("Genes missing from the dataset: %s" % ", ".join(missing))
+        exit(1)
+    return indices
+
+def genes_selection_by_index(X, genes):
+    """Select the given genes, in this order, by integer column index.
+    """
+    return X.iloc[:, genes_selection_indices(X, genes)]
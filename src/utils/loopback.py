@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# Copyright 2021 Owkin, inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""In-memory connections between participants running in the same process.
+
+A `LoopbackConnection` has the socket methods used by `utils.communication`,
+so codecs and tracing are the same as over TCP, without the sockets: all the
+participants of a federation run as threads of one process.
+
+Tensors sent without a codec are handed over in memory: only their frame
+header goes through the byte stream, the receiver takes the tensor itself.
+Encoded tensors are sent as frames, as over the network.
+"""
+import collections
+import threading
+
+
+class LoopbackConnection:
+    """One end of an in-memory byte stream.
+
+    Use `loopback_pair` to create connected ends.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.condition = threading.Condition()
+        self.closed = False
+        self.peer = None
+        # Tensors handed over by the peer, in the order of their headers
+        self.tensors = collections.deque()
+
+    def sendall(self, data):
+        self.send_tensor(data, None)
+
+    def send_tensor(self, header, tensor):
+        """Write a frame header and hand over its tensor, None for a byte frame.
+        """
+        peer = self.peer
+        with peer.condition:
+            if peer.closed:
+                raise BrokenPipeError("Loopback connection closed by peer.")
+            peer.buffer += header
+            if tensor is not None:
+                peer.tensors.append(tensor)
+            peer.condition.notify_all()
+
+    def receive_tensor(self):
+        """Take the tensor of the frame header just read.
+        """
+        with self.condition:
+            return self.tensors.popleft()
+
+    def send(self, data):
+        self.sendall(data)
+        return len(data)
+
+    def recv_into(self, buffer, nbytes=0):
+        view = memoryview(buffer).cast("B")
+        nbytes = nbytes or len(view)
+        with self.condition:
+            # An empty read means the connection was closed, as for a socket
+            self.condition.wait_for(lambda: self.buffer or self.closed)
+            nbytes = min(nbytes, len(self.buffer))
+            view[:nbytes] = self.buffer[:nbytes]
+            del self.buffer[:nbytes]
+        return nbytes
+
+    def recv(self, bufsize):
+        data = bytearray(bufsize)
+        return bytes(data[:self.recv_into(data)])
+
+    def close(self):
+        # Wake up the readers of both ends
+        for end in (self, self.peer):
+            with end.condition:
+                end.closed = True
+                end.condition.notify_all()
+
+
+def loopback_pair():
+    """Return two connected `LoopbackConnection`.
+    """
+    first, second = LoopbackConnection(), LoopbackConnection()
+    first.peer, second.peer = second, first
+    return first, second
+
+def loopback_federation(nb_clients):
+    """Connect a server to `nb_clients` clients in memory.
+
+    Returns:
+        (list[LoopbackConnection], list[LoopbackConnection]): Connections of
+            the server to each client, and of each client to the server.
+    """
+    pairs = [loopback_pair() for _ in range(nb_clients)]
+    return [server for server, _ in pairs], [client for _, client in pairs]
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# Copyright 2021 Owkin, inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Privacy accounting of DP-SGD with cached RDP curves.
+
+The RDP of the sampled Gaussian mechanism is additive over steps: the RDP of
+one step, for each order, is computed once per (sample rate, noise
+multiplier, orders) and memoized, in memory and on disk. Epsilon after any
+number of steps, and the number of steps fitting in an (epsilon, delta)
+budget, are then closed-form. Results are the same as the accounting of the
+opacus `PrivacyEngine`.
+"""
+import functools
+import hashlib
+import os
+import pathlib
+import tempfile
+
+import numpy as np
+from opacus import privacy_analysis
+
+DEFAULT_RDP_CACHE_DIR = str(pathlib.Path.home().joinpath(".cache", "owkin-submission", "rdp"))
+# Least recently used curves are removed beyond this number of files
+MAX_CACHED_CURVES = 4096
+# Budgets allowing more steps than this are considered unlimited
+MAX_BUDGET_STEPS = 2 ** 40
+
+
+def curve_file(sample_rate, noise_multiplier, alphas, cache_dir):
+    key = repr((float(sample_rate), float(noise_multiplier), alphas))
+    return os.path.join(cache_dir, hashlib.sha256(key.encode("utf-8")).hexdigest() + ".npy")
+
+def evict_curves(cache_dir, max_curves=MAX_CACHED_CURVES):
+    """Remove the least recently used curves of the disk cache beyond `max_curves`.
+    """
+    entries = [entry for entry in os.scandir(cache_dir) if entry.name.endswith(".npy")]
+    if len(entries) <= max_curves:
+        return
+    entries.sort(key=lambda entry: entry.stat().st_mtime)
+    for entry in entries[:len(entries) - max_curves]:
+        try:
+            os.remove(entry.path)
+        except OSError:
+            pass
+
+@functools.lru_cache(maxsize=1024)
+def step_rdp(sample_rate, noise_multiplier, alphas, cache_dir=DEFAULT_RDP_CACHE_DIR):
+    """Return the RDP of one DP-SGD step for each order.
+
+    Args:
+        sample_rate (float): Probability of each sample to be in a batch.
+        noise_multiplier (float): Noise multiplier.
+        alphas (tuple[float]): RDP orders.
+        cache_dir (str, optional): Disk cache directory, None to disable it.
+
+    Returns:
+        np.ndarray: Read-only RDP of each order.
+    """
+    if cache_dir is None:
+        rdp = np.asarray(privacy_analysis.compute_rdp(sample_rate, noise_multiplier, 1, list(alphas)))
+        rdp.flags.writeable = False
+        return rdp
+
+    file_path = curve_file(sample_rate, noise_multiplier, alphas, cache_dir)
+    try:
+        rdp = np.load(file_path)
+        # Mark as recently used
+        os.utime(file_path)
+    except (OSError, ValueError):
+        rdp = np.asarray(privacy_analysis.compute_rdp(sample_rate, noise_multiplier, 1, list(alphas)))
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            # Write then rename, so that a concurrent run never reads a partial file
+            fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+            with os.fdopen(fd, "wb") as file_writer:
+                np.save(file_writer, rdp)
+            os.replace(tmp_path, file_path)
+            evict_curves(cache_dir)
+        except OSError:
+            # The cache is an optimization only
+            pass
+    rdp.flags.writeable = False
+    return rdp
+
+def epsilon_from_rdp(rdp, alphas, delta):
+    """Return the (epsilon, best order) of an RDP curve, as opacus `get_privacy_spent`.
+    """
+    epsilon, best_alpha = privacy_analysis.get_privacy_spent(list(alphas), rdp, delta)
+    return float(epsilon), float(best_alpha)
+
+def compute_epsilon(sample_rate, noise_multiplier, steps, alphas, delta):
+    """Return the epsilon spent by `steps` DP-SGD steps.
+    """
+    alphas = tuple(alphas)
+    return epsilon_from_rdp(step_rdp(sample_rate, noise_multiplier, alphas) * steps, alphas, delta)[0]
+
+def steps_for_budget(sample_rate, noise_multiplier, alphas, epsilon, delta):
+    """Return the largest number of DP-SGD steps whose epsilon for `delta` is
+    at most `epsilon`.
+
+    Epsilon grows with the number of steps: the step count is bracketed by
+    doubling, then bisected, with O(log(steps)) evaluations of the curve.
+
+    Returns:
+        int: The number of steps, None if the budget allows more than
+            MAX_BUDGET_STEPS (e.g. no sampling, or an RDP rounded to 0).
+    """
+    alphas = tuple(alphas)
+    fits = lambda steps: compute_epsilon(sample_rate, noise_multiplier, steps, alphas, delta) <= epsilon
+    if fits(MAX_BUDGET_STEPS):
+        return None
+    if not fits(1):
+        return 0
+    low, high = 1, 2
+    while fits(high):
+        low, high = high, min(2 * high, MAX_BUDGET_STEPS)
+    while high - low > 1:
+        middle = (low + high) // 2
+        if fits(middle):
+            low = middle
+        else:
+            high = middle
+    return low
+
+
+class PrivacyAccountant:
+    """Running privacy budget of a DP-SGD training, updated at each step.
+
+    Args:
+        sample_rate (float): Probability of each sample to be in a batch.
+        noise_multiplier (float): Noise multiplier.
+        alphas (list[float]): RDP orders.
+        target_delta (float, optional): Default delta of the queries. Defaults to None.
+    """
+
+    def __init__(self, sample_rate, noise_multiplier, alphas, target_delta=None):
+        self.sample_rate = sample_rate
+        self.noise_multiplier = noise_multiplier
+        self.alphas = tuple(alphas)
+        self.target_delta = target_delta
+        self.rdp_step = step_rdp(sample_rate, noise_multiplier, self.alphas)
+        self.rdp = np.zeros_like(self.rdp_step)
+        self.steps = 0
+
+    def step(self, nb_steps=1):
+        self.steps += nb_steps
+        self.rdp += nb_steps * self.rdp_step
+
+    def get_privacy_spent(self, target_delta=None):
+        """Return the (epsilon, best alpha) privacy budget spent so far.
+
+        Args:
+            target_delta (float, optional): Defaults to the target delta of the accountant.
+        """
+        if target_delta is None:
+            target_delta = self.target_delta
+        return epsilon_from_rdp(self.rdp, self.alphas, target_delta)
+
+    def steps_for_budget(self, epsilon, delta=None):
+        """Return the total number of steps fitting in an (epsilon, delta) budget,
+        None if it is unlimited.
+        """
+        if delta is None:
+            delta = self.target_delta
+        return steps_for_budget(self.sample_rate, self.noise_multiplier, self.alphas, epsilon, delta)
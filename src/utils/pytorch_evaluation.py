@@ -13,6 +13,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
 import torch
 import numpy as np
 
@@ -23,17 +28,126 @@ def predict(model, X, threshold=0.5):
     Args:
         model (torch model): A Pytroch model
         X (dataloader): A dataframe-based gene dataset to predict on
+        threshold (float, optional): Tumor probability above which the prediction
+            is 1. With None, the probabilities are returned. Defaults to 0.5.
     """
     X_tensor, _  = convert_dataframe_to_tensor(X, [])
 
     model.eval()
     with torch.no_grad():
-        y_pred = (model(X_tensor) >= threshold).int().numpy()
+        y_pred = model(X_tensor)
+        y_pred = y_pred.numpy() if threshold is None else (y_pred >= threshold).int().numpy()
+
+    return y_pred
+
+def predict_many(models, X, threshold=0.5):
+    """Generate NumPy output predictions of several logistic regression models at once.
+
+    The weights of the models are stacked in a single matrix so that all models
+    are scored with one matrix product.
+
+    Args:
+        models (list[LogisticRegression]): Models sharing the same input size
+        X (dataloader): A dataframe-based gene dataset to predict on
+        threshold (float, optional): Tumor probability above which the prediction
+            is 1. With None, the probabilities are returned. Defaults to 0.5.
+
+    Returns:
+        np.ndarray: Predictions, one column per model.
+    """
+    X_tensor, _  = convert_dataframe_to_tensor(X, [])
+
+    with torch.no_grad():
+        weights = torch.cat([model.linear.weight for model in models])
+        biases = torch.cat([model.linear.bias for model in models])
+        y_pred = torch.sigmoid(torch.addmm(biases, X_tensor, weights.t()))
+        y_pred = y_pred.numpy() if threshold is None else (y_pred >= threshold).int().numpy()
 
     return y_pred
 
 def convert_dataframe_to_tensor(X, y):
-    tensor_x = torch.Tensor(X.to_numpy().astype(np.float32))
+    tensor_x = torch.from_numpy(np.array(X, dtype=np.float32))
     tensor_y = torch.Tensor(y)
     return tensor_x, tensor_y
 
+class DynamicBatcher:
+    """Group concurrent prediction requests of a logistic regression model into
+    a single matrix product, run by a background thread.
+
+    Requests waiting in the queue when the thread becomes free are scored
+    together, up to `max_batch_size` samples. With `max_wait` > 0, the thread
+    also waits that long for more requests before scoring a batch.
+
+    Args:
+        model (LogisticRegression): Trained model.
+        max_batch_size (int, optional): Maximum number of samples per batch. Defaults to 256.
+        max_wait (float, optional): Time to wait for more requests, in seconds. Defaults to 0.
+    """
+    def __init__(self, model, max_batch_size=256, max_wait=0.0):
+        self.weight = model.linear.weight.detach().t().contiguous()
+        self.bias = model.linear.bias.detach().clone()
+        self.input_size = self.weight.shape[0]
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, samples):
+        """Queue samples for scoring.
+
+        Args:
+            samples (np.ndarray): float32 samples, one per row, in the gene order of the model.
+                A single sample can be given as a vector.
+
+        Returns:
+            Future: resolves to the tumor probability of each sample.
+        """
+        samples = np.require(samples, dtype=np.float32, requirements=["C", "W"])
+        if samples.ndim == 1:
+            samples = samples.reshape(1, -1)
+        if samples.ndim != 2 or samples.shape[1] != self.input_size:
+            raise ValueError("Expected samples of %d values, got an array of shape %s." % (
+                self.input_size, samples.shape))
+        future = Future()
+        self.requests.put((samples, future))
+        return future
+
+    def predict_proba(self, samples):
+        return self.submit(samples).result()
+
+    def _next_batch(self):
+        batch = [self.requests.get()]
+        nb_samples = len(batch[0][0])
+        deadline = time.perf_counter() + self.max_wait
+        while nb_samples < self.max_batch_size:
+            try:
+                timeout = deadline - time.perf_counter()
+                if timeout > 0:
+                    request = self.requests.get(timeout=timeout)
+                else:
+                    request = self.requests.get_nowait()
+            except queue.Empty:
+                break
+            batch.append(request)
+            nb_samples += len(request[0])
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                if len(batch) == 1:
+                    X = torch.from_numpy(batch[0][0])
+                else:
+                    X = torch.from_numpy(np.concatenate([samples for samples, _ in batch]))
+                with torch.no_grad():
+                    probabilities = torch.sigmoid(torch.addmm(self.bias, X, self.weight)).view(-1).numpy()
+            except Exception as error:
+                for _, future in batch:
+                    future.set_exception(error)
+                continue
+            idx = 0
+            for samples, future in batch:
+                future.set_result(probabilities[idx: idx + len(samples)])
+                idx += len(samples)
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# Copyright 2021 Owkin, inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Poisson sampling of the training batches.
+
+Each sample is included in a batch independently with probability
+`sample_rate`, as assumed by the privacy accounting of DP-SGD.
+"""
+import numpy as np
+import torch
+
+
+class PoissonSampler:
+    """Draw the batches of all the training steps at once, and gather each
+    batch into buffers reused across steps.
+
+    By default the draws come from the global numpy generator, so that batches
+    are the same as drawing `np.random.uniform(0, 1, len(samples))` at each
+    step. With `secure`, they come from a cryptographically secure generator
+    (torchcsprng), as the noise of the `PrivacyEngine` with `secure_rng=True`.
+
+    Args:
+        samples (np.ndarray): float32 samples, one row per sample.
+        labels (np.ndarray): float32 labels.
+        sample_rate (float): Probability of each sample to be in a batch.
+        nb_steps (int): Number of batches to draw.
+        secure (bool, optional): Draw from a CSPRNG. Defaults to False.
+    """
+
+    def __init__(self, samples, labels, sample_rate, nb_steps, secure=False):
+        # Memory-mapped datasets are read-only, torch needs writable arrays
+        self.samples = torch.from_numpy(np.require(samples, np.float32, ["C", "W"]))
+        self.labels = torch.from_numpy(np.require(labels, np.float32, ["C", "W"]))
+        self.sample_rate = sample_rate
+        self.nb_steps = nb_steps
+
+        shape = (nb_steps, len(self.samples))
+        if secure:
+            import torchcsprng
+
+            generator = torchcsprng.create_random_device_generator("/dev/urandom")
+            draws = torch.empty(shape, dtype=torch.float64).uniform_(0, 1, generator=generator).numpy()
+        else:
+            draws = np.random.uniform(0, 1, shape)
+
+        # Indices of all the batches, concatenated in step order
+        steps, indices = np.nonzero(draws < sample_rate)
+        self.indices = torch.from_numpy(indices)
+        self.batch_sizes = np.bincount(steps, minlength=nb_steps).tolist()
+        self.offsets = np.concatenate([[0], np.cumsum(self.batch_sizes)]).tolist()
+
+        max_batch_size = max(self.batch_sizes, default=0)
+        self.samples_buffer = self.samples.new_empty((max_batch_size,) + tuple(self.samples.shape[1:]))
+        self.labels_buffer = self.labels.new_empty((max_batch_size,) + tuple(self.labels.shape[1:]))
+        self.step = 0
+
+    def __len__(self):
+        return self.nb_steps
+
+    def next_batch(self):
+        """Return the samples and labels of the next batch.
+
+        The returned tensors are views of the sampler buffers: they are
+        overwritten by the next call.
+        """
+        if self.step >= self.nb_steps:
+            raise IndexError("All the %d batches have been drawn." % self.nb_steps)
+        batch_size = self.batch_sizes[self.step]
+        indices = self.indices.narrow(0, self.offsets[self.step], batch_size)
+        self.step += 1
+
+        x = self.samples_buffer.narrow(0, 0, batch_size)
+        y = self.labels_buffer.narrow(0, 0, batch_size)
+        torch.index_select(self.samples, 0, indices, out=x)
+        torch.index_select(self.labels, 0, indices, out=y)
+        return x, y
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# Copyright 2021 Owkin, inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Opt-in timeline tracing of the training hot path.
+
+Events are recorded in the Chrome trace event format, with wall-clock
+timestamps so that the traces of all participants can be loaded together
+(chrome://tracing or https://ui.perfetto.dev). A `.jsonl` output file gets one
+event per line instead of a single JSON document.
+
+Tracing is disabled by default: `get_tracer` then returns a tracer whose
+methods do nothing.
+"""
+import contextlib
+import json
+import os
+import threading
+import time
+
+
+class NullTracer:
+    enabled = False
+
+    def span(self, name, **args):
+        return contextlib.nullcontext(args)
+
+    def counter(self, name, **values):
+        pass
+
+    def close(self):
+        pass
+
+
+class Tracer:
+    """Record spans and counters of one participant.
+
+    Args:
+        file_path (str): Output file, `.jsonl` for one event per line.
+        participant (str): Name of the participant, used as process name.
+    """
+    enabled = True
+
+    def __init__(self, file_path, participant):
+        self.file_path = file_path
+        self.pid = os.getpid()
+        self.events = [{
+            "name": "process_name", "ph": "M", "pid": self.pid, "tid": 0,
+            "args": {"name": participant},
+        }]
+        # Precise relative clock, shifted to the wall clock of the host
+        self.offset = time.time() - time.perf_counter()
+
+    def now(self):
+        return (time.perf_counter() + self.offset) * 1e6
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        """Time the enclosed block. The `args` dict can be updated inside the block.
+        """
+        start = self.now()
+        try:
+            yield args
+        finally:
+            self.events.append({
+                "name": name, "ph": "X", "ts": start, "dur": self.now() - start,
+                "pid": self.pid, "tid": threading.get_ident(), "args": args,
+            })
+
+    def counter(self, name, **values):
+        self.events.append({
+            "name": name, "ph": "C", "ts": self.now(), "pid": self.pid, "tid": 0, "args": values,
+        })
+
+    def close(self):
+        with open(self.file_path, "w") as file_writer:
+            if self.file_path.endswith(".jsonl"):
+                for event in self.events:
+                    file_writer.write(json.dumps(event) + "\n")
+            else:
+                json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, file_writer)
+
+
+TRACER = NullTracer()
+
+def get_tracer():
+    return TRACER
+
+def participant_trace_file(file_path, participant, worker=None):
+    """Suffix a trace file name with the participant (and worker), so that
+    processes running on the same host do not overwrite each other.
+    """
+    root, ext = os.path.splitext(file_path)
+    suffix = participant if worker is None else "%s-worker%d" % (participant, worker)
+    return "%s-%s%s" % (root, suffix, ext or ".json")
+
+def start_tracing(file_path, participant):
+    global TRACER
+    TRACER = Tracer(file_path, participant)
+    return TRACER
+
+def stop_tracing():
+    global TRACER
+    TRACER.close()
+    TRACER = NullTracer()